@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""Prueba de carga offline: reproduce miles de conversaciones concurrentes contra la app
+usando un servidor OpenAI simulado (determinista, latencia configurable). No usa red ni API key.
+
+Uso:
+    python bench_carga.py --conversaciones 2000 --concurrencia 200 --latencia-llm 800
+    python bench_carga.py --modo uvicorn --salida resultados.json
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import tempfile
+import threading
+import time
+
+import httpx
+import openai
+import uvicorn
+from dotenv import load_dotenv
+from fastapi import FastAPI, Request
+
+PUERTO_APP = 8765
+PUERTO_STUB = 8766
+
+# Fases de test.py; los {} se rellenan con variaciones para que no todo pegue en cache
+FASES = [
+    ["hola", "qué productos tienes?", "y qué me recomiendas?"],
+    ["quiero {n} empanadas y una pizza", "ponle {n} deditos de mozzarella", "cancela la pizza", "cuánto va el total?"],
+    ["cómo pago?", "transferencia", "sí, confírmalo"],
+    ["venden bebidas?", "es congelado o ya viene listo?", "se puede recoger en tienda?",
+     "tengo alergia, qué ingredientes tienen las {producto}?"],
+    ["estoy planeando una reunión familiar de {n} personas", "gracias"],
+]
+PRODUCTOS_VARIACION = ["empanadas", "pizzas", "deditos", "pasteles de pollo"]
+
+
+# ========== Servidor OpenAI simulado ==========
+def crear_stub_openai(latencia_ms: float, jitter_ms: float) -> FastAPI:
+    stub = FastAPI()
+    stub.state.llamadas = 0
+
+    @stub.post("/v1/chat/completions")
+    async def completions(request: Request):
+        cuerpo = await request.json()
+        stub.state.llamadas += 1
+        mensaje = cuerpo["messages"][-1]["content"]
+        # Latencia y respuesta deterministas a partir del contenido
+        semilla = int(hashlib.md5(mensaje.encode()).hexdigest()[:8], 16)
+        rnd = random.Random(semilla)
+        await asyncio.sleep(max(0.0, latencia_ms + rnd.uniform(-jitter_ms, jitter_ms)) / 1000)
+        contenido = json.dumps({
+            "intencion": rnd.choice(["recomendacion", "detalles_producto", "no_disponible"]),
+            "items": [],
+            "metodo": "",
+            "modo": "",
+            "respuesta": "¡Claro! 😊 Te recomiendo nuestras empanadas. ¿Te agrego algunas?",
+        }, ensure_ascii=False)
+        return {
+            "id": f"chatcmpl-{semilla:x}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": cuerpo.get("model", "stub"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": contenido}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(mensaje) // 4, "completion_tokens": len(contenido) // 4,
+                      "total_tokens": (len(mensaje) + len(contenido)) // 4},
+        }
+
+    return stub
+
+
+# ========== Generador de carga ==========
+def conversacion_sintetica(rnd: random.Random):
+    mensajes = []
+    for fase in FASES:
+        for plantilla in fase:
+            mensajes.append(plantilla.format(n=rnd.randint(1, 12), producto=rnd.choice(PRODUCTOS_VARIACION)))
+    return mensajes
+
+
+async def reproducir(cliente: httpx.AsyncClient, conversaciones: int, concurrencia: int, semilla: int):
+    rnd = random.Random(semilla)
+    guiones = [conversacion_sintetica(rnd) for _ in range(conversaciones)]
+    latencias = []
+    errores = 0
+    semaforo = asyncio.Semaphore(concurrencia)
+
+    async def una(i, mensajes):
+        nonlocal errores
+        async with semaforo:
+            uid = f"bench_{semilla}_{i}"
+            for texto in mensajes:
+                t0 = time.perf_counter()
+                try:
+                    r = await cliente.post("/webhook/demo", json={"texto": texto, "usuario_id": uid})
+                    if r.status_code != 200 or r.json().get("estado") == "error":
+                        errores += 1
+                except httpx.HTTPError:
+                    errores += 1
+                latencias.append(time.perf_counter() - t0)
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(una(i, m) for i, m in enumerate(guiones)))
+    return latencias, errores, time.perf_counter() - inicio
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p))]
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _servir_en_hilo(app, puerto):
+    servidor = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=puerto, log_level="warning"))
+    threading.Thread(target=servidor.run, daemon=True).start()
+    while not servidor.started:
+        time.sleep(0.05)
+    return servidor
+
+
+async def ejecutar(args):
+    stub = crear_stub_openai(args.latencia_llm, args.jitter_llm)
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    # Pedidos, sesiones y cache en disco van a un directorio temporal: una corrida no debe
+    # dejar miles de pedidos bench_* en el pedidos.jsonl real ni tocar las bases SQLite
+    load_dotenv()  # lo mismo que hará main; las variables ya fijadas aquí tienen prioridad
+    temporal = tempfile.mkdtemp(prefix="bench_carga_")
+    os.environ["PEDIDOS_ARCHIVO"] = os.path.join(temporal, "pedidos.jsonl")
+    os.environ["SESIONES_DB"] = os.path.join(temporal, "sesiones.db")
+    if os.environ.get("LLM_CACHE_L2_DB"):  # vacío = solo memoria, se respeta
+        os.environ["LLM_CACHE_L2_DB"] = os.path.join(temporal, "cache_llm.db")
+    os.environ["CATALOGO_RECARGA_S"] = "0"
+    import main  # después de fijar el entorno: main lee la configuración al importarse
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("VendedorInteligente").setLevel(logging.WARNING)
+
+    if args.modo == "uvicorn":
+        _servir_en_hilo(stub, PUERTO_STUB)
+        main._CLIENTE_LLM = openai.AsyncOpenAI(api_key="stub", base_url=f"http://127.0.0.1:{PUERTO_STUB}/v1",
+                                               timeout=main.LLM_TIMEOUT_S)
+        _servir_en_hilo(main.app, PUERTO_APP)
+        cliente = httpx.AsyncClient(base_url=f"http://127.0.0.1:{PUERTO_APP}", timeout=60,
+                                    limits=httpx.Limits(max_connections=args.concurrencia))
+        contexto = None
+    else:
+        # Todo en proceso: la app y el stub se hablan por ASGI sin sockets
+        main._CLIENTE_LLM = openai.AsyncOpenAI(
+            api_key="stub", base_url="http://stub/v1", timeout=main.LLM_TIMEOUT_S,
+            http_client=httpx.AsyncClient(transport=httpx.ASGITransport(app=stub), base_url="http://stub/v1"),
+        )
+        cliente = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://app", timeout=60)
+        contexto = main.ciclo_de_vida(main.app)
+        await contexto.__aenter__()
+
+    rss_inicial = rss_mb()
+    try:
+        latencias, errores, duracion = await reproducir(cliente, args.conversaciones, args.concurrencia, args.semilla)
+    finally:
+        await cliente.aclose()
+        if contexto is not None:
+            await contexto.__aexit__(None, None, None)
+
+    mensajes = len(latencias)
+    cache = main.LLM_CACHE.estadisticas()
+    return {
+        "parametros": vars(args),
+        "mensajes": mensajes,
+        "errores": errores,
+        "duracion_s": round(duracion, 3),
+        "rps": round(mensajes / duracion, 1) if duracion else 0.0,
+        "latencia_ms": {
+            "p50": round(percentil(latencias, 0.50) * 1000, 2),
+            "p95": round(percentil(latencias, 0.95) * 1000, 2),
+            "p99": round(percentil(latencias, 0.99) * 1000, 2),
+            "media": round(statistics.fmean(latencias) * 1000, 2) if latencias else 0.0,
+        },
+        "llm": {
+            "llamadas": stub.state.llamadas,
+            "llamadas_por_mensaje": round(stub.state.llamadas / mensajes, 4) if mensajes else 0.0,
+        },
+        "cache_llm": cache,
+        "tiers": {t: sum(h.conteos) for t, h in main.METRICAS.peticiones.items()},
+        "memoria_mb": {
+            "inicial": round(rss_inicial, 1),
+            "final": round(rss_mb(), 1),
+            "crecimiento": round(rss_mb() - rss_inicial, 1),
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversaciones", type=int, default=1000)
+    parser.add_argument("--concurrencia", type=int, default=100)
+    parser.add_argument("--latencia-llm", type=float, default=800, help="ms por llamada al LLM simulado")
+    parser.add_argument("--jitter-llm", type=float, default=200, help="± ms de variación")
+    parser.add_argument("--modo", choices=["proceso", "uvicorn"], default="proceso")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--salida", default="bench_carga.json", help="archivo JSON con los resultados")
+    args = parser.parse_args()
+
+    resultado = asyncio.run(ejecutar(args))
+    with open(args.salida, "w", encoding="utf-8") as f:
+        json.dump(resultado, f, indent=2, ensure_ascii=False)
+    print(json.dumps(resultado, indent=2, ensure_ascii=False))
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmark del extractor de productos: trie (con índice difuso) vs. el escaneo de cuatro regex anterior.
+
+Uso: python bench_extractor.py [--repeticiones N]
+"""
+import argparse
+import re
+import timeit
+
+import main
+
+CORPUS = [
+    "hola",
+    "qué productos tienes?",
+    "y qué me recomiendas?",
+    "quiero 2 empanadas y una pizza",
+    "ponle 3 deditos de mozzarella",
+    "cancela la pizza",
+    "cuánto va el total?",
+    "cómo pago?",
+    "transferencia",
+    "sí, confírmalo",
+    "venden bebidas?",
+    "es congelado o ya viene listo?",
+    "se puede recoger en tienda?",
+    "tengo alergia, qué ingredientes tienen las empanadas?",
+    "estoy planeando una reunión familiar",
+    "gracias",
+    "me gustaría una docena de empanadas y media docena de pasteles de pollo por favor",
+    "dame 4 pizzas personales, 2 deditos y 10 empanadas para la oficina",
+    "buenas, necesito 20 empanadas de carne y 15 de pollo para el sábado",
+    "tres pasteles de pollo",
+    # Errores de tipeo: los resuelve el índice difuso
+    "quiero 3 empanadaz y una pisa",
+    "dame 2 dedos de mozarela",
+    "pasteles d pollo pf",
+]
+
+
+# Copia congelada de la implementación anterior, solo como referencia de rendimiento
+def _legacy_normaliza_producto(token, alias, productos):
+    t = token.strip().lower()
+    if t in alias:
+        return alias[t]
+    for a, canon in alias.items():
+        if a in t:
+            return canon
+    if t in productos:
+        return t
+    return None
+
+
+def _legacy_primer_match_producto(fragmento, alias, productos):
+    tokens = fragmento.split()
+    for span in [3, 2, 1]:
+        prod = _legacy_normaliza_producto(" ".join(tokens[:span]), alias, productos)
+        if prod:
+            return prod
+    for tok in tokens:
+        prod = _legacy_normaliza_producto(tok, alias, productos)
+        if prod:
+            return prod
+    return None
+
+
+def legacy_extraer(texto, alias, productos, num_palabras):
+    texto = texto.lower()
+    patrones = [
+        r"(\d+)\s+([a-záéíóúñ ]+)(?=\s|$|\.|,)",
+        r"\b(" + "|".join(re.escape(k) for k in num_palabras.keys()) + r")\b\s+([a-záéíóúñ ]+)(?=\s|$|\.|,)",
+        r"(?:quiero|dame|ponme|agrega|agregar|me gustaría|deseo)\s+(\d+)?\s*([a-záéíóúñ ]+)",
+        r"(\d+)?\s*([a-záéíóúñ ]+)(?:\s+por\s+favor|\s+pf|\s+pls)?"
+    ]
+    candidatos = []
+    for patron in patrones:
+        for match in re.finditer(patron, texto):
+            cantidad = 1
+            g1, g2 = match.group(1), match.group(2)
+            if g1 and g1.isdigit():
+                cantidad = int(g1)
+            elif g1 and g1 in num_palabras:
+                cantidad = num_palabras[g1]
+            resto = (g2 or "").strip()
+            if resto:
+                prod = _legacy_primer_match_producto(resto, alias, productos)
+                if prod and prod in productos:
+                    candidatos.append({"producto": prod, "cantidad": cantidad})
+    if not candidatos:
+        for a, canon in alias.items():
+            if re.search(rf"\b{re.escape(a)}\b", texto) and canon in productos:
+                candidatos.append({"producto": canon, "cantidad": 1})
+                break
+    items_out = []
+    for it in candidatos:
+        existente = next((i for i in items_out if i["producto"] == it["producto"]), None)
+        if existente:
+            existente["cantidad"] += it["cantidad"]
+        else:
+            items_out.append(it)
+    return items_out
+
+
+def alias_ampliados(factor):
+    """Multiplica la lista de alias con variantes sintéticas que no aparecen en el corpus"""
+    alias = dict(main.CATALOGO.alias)
+    for k in range(1, factor):
+        for a, canon in main.CATALOGO.alias.items():
+            alias[f"{a} variante{k}"] = canon
+    return alias
+
+
+def medir(fn, repeticiones):
+    segundos = min(timeit.repeat(lambda: [fn(t) for t in CORPUS], number=repeticiones, repeat=3))
+    return segundos / (repeticiones * len(CORPUS)) * 1e6
+
+
+def main_bench(repeticiones):
+    print(f"{'alias':>6} | {'regex (µs/msg)':>15} | {'trie (µs/msg)':>14} | {'mejora':>7}")
+    for factor in (1, 10):
+        alias = alias_ampliados(factor)
+        catalogo = main.CATALOGO
+        extractor = main.ExtractorProductos(alias, catalogo.productos, catalogo.num_palabras)
+        t_legacy = medir(lambda t: legacy_extraer(t, alias, catalogo.productos, catalogo.num_palabras), repeticiones)
+        t_trie = medir(extractor.extraer, repeticiones)
+        print(f"{len(alias):>6} | {t_legacy:>15.1f} | {t_trie:>14.1f} | {t_legacy / t_trie:>6.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeticiones", type=int, default=200)
+    main_bench(parser.parse_args().repeticiones)
@@ -1,529 +1,2505 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from dotenv import load_dotenv
-import os, openai, json, time, logging, random, re
-from typing import Dict, List, Optional, Tuple
-from datetime import datetime
-import hashlib
-
-# ========== Setup ==========
-load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
-
-app = FastAPI()
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-logger = logging.getLogger("VendedorInteligente")
-
-# ========== Datos ==========
-PRODUCTOS = {
-    "empanadas": {"nombre": "Empanadas", "precio": 1500, "descripcion": "Crujientes rellenas de carne o pollo", "categoria": "popular"},
-    "pasteles de pollo": {"nombre": "Pasteles de pollo", "precio": 2500, "descripcion": "Suaves y con verduras frescas", "categoria": "popular"},
-    "pizza personal": {"nombre": "Pizza personal", "precio": 5900, "descripcion": "Deliciosa pizza individual", "categoria": "especial"},
-    "deditos de mozzarella": {"nombre": "Deditos de mozzarella", "precio": 2600, "descripcion": "Queso mozzarella empanizado", "categoria": "aperitivo"}
-}
-
-ALIAS_PRODUCTOS = {
-    "empanada": "empanadas", "empanadas": "empanadas", "empana": "empanadas",
-    "pastel": "pasteles de pollo", "pastel de pollo": "pasteles de pollo", "pasteles": "pasteles de pollo",
-    "pizza": "pizza personal", "pizza personal": "pizza personal", "pizzas": "pizza personal",
-    "deditos": "deditos de mozzarella", "deditos de mozzarella": "deditos de mozzarella", "mozzarella": "deditos de mozzarella",
-}
-
-NUM_PALABRAS = {
-    "un": 1, "uno": 1, "una": 1,
-    "dos": 2, "tres": 3, "cuatro": 4, "cinco": 5,
-    "seis": 6, "siete": 7, "ocho": 8, "nueve": 9, "diez": 10,
-    "docena": 12, "una docena": 12, "media docena": 6
-}
-
-PROMOCIONES = [
-    "🎉 ¡Compra 10 empanadas y lleva 2 GRATIS!",
-    "🔥 Pizza personal + deditos por solo $9,900",
-    "💫 3 pasteles de pollo por $6,900",
-    "👨‍👩‍👧‍👦 Combo familiar: 2 pizzas + deditos $15,900",
-]
-
-DESPEDIDAS = [
-    "¡Gracias por tu visita! Hasta pronto 😊",
-    "¡Fue un placer ayudarte! ¡Vuelve pronto!",
-    "¡Nos vemos! 🌈 Que tengas un día delicioso.",
-    "¡Hasta luego! 🎯 Espero verte de nuevo pronto."
-]
-
-POLITICA_DATOS_LINK = "https://congelados-demo.com/politica-datos"
-
-ESTADOS: Dict[str, Dict] = {}
-LLM_CACHE: Dict[str, Dict] = {}  # Cache para respuestas del LLM
-
-# ========== Utilidades Mejoradas ==========
-def get_time_emoji() -> str:
-    hour = datetime.now().hour
-    if hour < 12: return "☀️"
-    if hour < 18: return "🌤️"
-    return "🌙"
-
-def saludo_dinamico() -> str:
-    """Saludo natural sin promociones forzadas"""
-    emoji_tiempo = get_time_emoji()
-    
-    saludos_base = [
-        f"¡Hola! {emoji_tiempo} Bienvenido a Congelados Deliciosos",
-        f"¡Qué gusto verte por aquí! 👋 {emoji_tiempo}", 
-        f"¡Hola! 🌟 Me da mucho gusto saludarte {emoji_tiempo}",
-        f"¡Bienvenido! 🥟 {emoji_tiempo} ¿Cómo estás?"
-    ]
-    
-    saludo = random.choice(saludos_base)
-    
-    # Ocasionalmente mencionar promoción suavemente (30% probabilidad)
-    if random.random() < 0.3:
-        promocion = random.choice(PROMOCIONES)
-        return f"{saludo}. Por cierto, {promocion.lower()} ¿Te interesa?"
-    
-    return f"{saludo}. ¿En qué puedo ayudarte hoy?"
-
-def generar_respuesta_promociones() -> str:
-    """Respuesta dedicada para cuando preguntan por promociones"""
-    promociones_texto = "\n".join([f"• {p}" for p in PROMOCIONES])
-    return f"¡Claro! Tenemos estas promociones 🎉:\n\n{promociones_texto}\n\n¿Alguna te llama la atención? 😊"
-
-def formatear_respuesta_web(mensaje: str) -> str:
-    return mensaje.replace("\n", "<br>")
-
-def normaliza_producto(token: str) -> Optional[str]:
-    t = token.strip().lower()
-    if t in ALIAS_PRODUCTOS:
-        return ALIAS_PRODUCTOS[t]
-    for alias, canon in ALIAS_PRODUCTOS.items():
-        if alias in t:
-            return canon
-    if t in PRODUCTOS:
-        return t
-    return None
-
-def _primer_match_producto(fragmento: str) -> Optional[str]:
-    tokens = fragmento.split()
-    for span in [3, 2, 1]:
-        frag_corto = " ".join(tokens[:span])
-        prod = normaliza_producto(frag_corto)
-        if prod:
-            return prod
-    for tok in tokens:
-        prod = normaliza_producto(tok)
-        if prod:
-            return prod
-    return None
-
-def extraer_productos_y_cantidades(texto: str) -> List[Dict]:
-    texto = texto.lower()
-    items: List[Dict] = []
-
-    patrones = [
-        r"(\d+)\s+([a-záéíóúñ ]+)(?=\s|$|\.|,)",
-        r"\b(" + "|".join(re.escape(k) for k in NUM_PALABRAS.keys()) + r")\b\s+([a-záéíóúñ ]+)(?=\s|$|\.|,)",
-        r"(?:quiero|dame|ponme|agrega|agregar|me gustaría|deseo)\s+(\d+)?\s*([a-záéíóúñ ]+)",
-        r"(\d+)?\s*([a-záéíóúñ ]+)(?:\s+por\s+favor|\s+pf|\s+pls)?"
-    ]
-
-    candidatos: List[Dict] = []
-
-    for patron in patrones:
-        for match in re.finditer(patron, texto):
-            cantidad = 1
-            resto = ""
-
-            if match.lastindex and match.lastindex >= 2:
-                g1 = match.group(1)
-                g2 = match.group(2)
-                if g1 and g1.isdigit():
-                    cantidad = int(g1)
-                elif g1 and g1 in NUM_PALABRAS:
-                    cantidad = NUM_PALABRAS[g1]
-                resto = (g2 or "").strip()
-            elif match.lastindex == 1:
-                resto = (match.group(1) or "").strip()
-
-            if resto:
-                prod = _primer_match_producto(resto)
-                if prod and prod in PRODUCTOS:
-                    candidatos.append({"producto": prod, "cantidad": cantidad})
-
-    # Detección de productos sueltos
-    if not candidatos:
-        for alias, canon in ALIAS_PRODUCTOS.items():
-            if re.search(rf"\b{re.escape(alias)}\b", texto) and canon in PRODUCTOS:
-                # Verificar que no sea parte de una frase más larga ya detectada
-                if not any(alias in str(cand) for cand in candidatos):
-                    candidatos.append({"producto": canon, "cantidad": 1})
-                break
-
-    # Merge de duplicados
-    items_out: List[Dict] = []
-    for it in candidatos:
-        existente = next((i for i in items_out if i["producto"] == it["producto"]), None)
-        if existente:
-            existente["cantidad"] += it["cantidad"]
-        else:
-            items_out.append(it)
-
-    return items_out
-
-def extraer_json(texto: str) -> str:
-    s = texto.strip()
-    if s.startswith("```"):
-        s = re.sub(r"^```(?:json)?\s*", "", s)
-        s = re.sub(r"\s*```$", "", s)
-    m = re.search(r"\{.*\}", s, re.DOTALL)
-    return m.group(0) if m else s
-
-def validar_items_llm(items: List[Dict]) -> List[Dict]:
-    validos = []
-    for item in items or []:
-        if isinstance(item, dict) and "producto" in item and item["producto"] in PRODUCTOS:
-            cantidad = max(1, int(item.get("cantidad", 1)))
-            validos.append({"producto": item["producto"], "cantidad": cantidad})
-        else:
-            logger.warning(f"Item inválido del LLM: {item}")
-    return validos
-
-def generar_hash_texto(texto: str) -> str:
-    """Genera hash para cache de LLM"""
-    return hashlib.md5(texto.encode()).hexdigest()
-
-# ========== Detección rápida mejorada ==========
-def detectar_intencion_basica(texto: str) -> Optional[Dict]:
-    t = texto.lower()
-
-    # Saludos mejorados - SIN promoción en el saludo
-    saludos_patrones = [
-        r'^(hola|hey|hi|hello|buen[oa]s(\s*(d[ií]as|tardes|noches))?)\b',
-        r'\b(qu[eé]\s*tal|c[oó]mo\s*est[aá]s|saludos|buen[oa]s)\b',
-        r'^(ola|hey|hi|hello|buenas)'
-    ]
-    
-    for patron in saludos_patrones:
-        if re.search(patron, t):
-            return {"intencion": "saludo", "respuesta": saludo_dinamico()}  # ← SOLO saludo, sin promoción
-
-    # Nueva detección para promociones específicas
-    if re.search(r'\b(promociones?|ofertas?|descuentos?|especiales)\b', t):
-        return {"intencion": "promociones", "respuesta": generar_respuesta_promociones()}
-
-    # Menú / catálogo
-    if re.search(r'\b(men[úu]|menu|productos|cat[aá]logo|qu[eé]\s*(tienes|vendes)|oferta|ofertas)\b', t):
-        productos = "\n".join([f"• {p['nombre']} - ${p['precio']:,}" for p in PRODUCTOS.values()])
-        return {"intencion": "menu", "respuesta": f"Aquí va nuestro menú 🧊:\n\n{productos}\n\n¿Te antoja algo? 😋"}
-
-    # Bebidas / no disponible
-    if re.search(r'\b(bebidas?|gaseosa|jugo|agua|refresco|cerveza|licor|vino)\b', t):
-        sugeridos = "empanadas, pasteles de pollo o deditos de mozzarella"
-        return {"intencion": "no_disponible", "respuesta": f"Por ahora no manejamos bebidas 😅. Pero te puedo recomendar {sugeridos} — ¡son un hit! ¿Te gustaría agregar alguno? 😋"}
-
-    # Entrega
-    if re.search(r'\b(domicilio|env[ií]o|delivery|a mi casa|a domicilio|entregar|mandar)\b', t):
-        return {"intencion": "entrega", "modo": "domicilio",
-                "respuesta": f"🚚 Perfecto, envío a domicilio. Protegemos tus datos según nuestras políticas: {POLITICA_DATOS_LINK}. ¿Deseas confirmar el pedido? ✅"}
-    
-    if re.search(r'\b(recoger|tienda|punto de recogida|pick\s*up|pasar por|buscar|recojer)\b', t):
-        return {"intencion": "entrega", "modo": "tienda",
-                "respuesta": "🏪 Genial, recoger en tienda. ¿Confirmamos tu pedido ahora? ✅"}
-
-    # Total
-    if re.search(r'\b(total|cu[aá]nto\s+(va|debo|es|cuesta)|suma|valor)\b', t):
-        return {"intencion": "total"}
-
-    # Confirmar
-    if re.search(r'\b(confirmar|confirmo|listo|ok|vale|s[ií]|acepto|de acuerdo)\b', t):
-        return {"intencion": "confirmar"}
-
-    # Despedida
-    if re.search(r'\b(gracias|chao|adi[óo]s|hasta luego|bye|nos vemos|finalizar|terminar)\b', t):
-        return {"intencion": "despedida", "respuesta": random.choice(DESPEDIDAS)}
-
-    return None
-
-# ========== LLM conversacional con cache ==========
-def interpretar_mensaje_con_LLM(texto_usuario: str, estado_actual=None) -> Dict:
-    try:
-        # Generar hash para cache
-        texto_hash = generar_hash_texto(texto_usuario)
-        if texto_hash in LLM_CACHE:
-            logger.info(f"Usando respuesta cacheada para: {texto_usuario}")
-            return LLM_CACHE[texto_hash]
-
-        resumen = "\n".join([
-            f"- {i['cantidad']} x {PRODUCTOS[i['producto']]['nombre']}"
-            for i in (estado_actual.get("items", []) if estado_actual else [])
-        ]) or "Ninguno."
-
-        catalogo = "\n".join([
-            f"{p['nombre']} - ${p['precio']} ({p['descripcion']})"
-            for p in PRODUCTOS.values()
-        ])
-
-        prompt = f"""
-Eres "Tu Vendedor Inteligente" para "Congelados Deliciosos". Responde cálido y profesional.
-
-CATÁLOGO (SOLO estos productos):
-{catalogo}
-
-PEDIDO ACTUAL:
-{resumen}
-
-MENSAJE DEL CLIENTE:
-"{texto_usuario}"
-
-REGLAS:
-- SOLO usar productos del catálogo
-- Si preguntan por algo no disponible, sugiere 1-3 alternativas del catálogo
-- Respuestas breves (máx 100 palabras), con emojis
-- Termina con una pregunta amable (CTA)
-
-Devuelve SOLO JSON:
-{{
-  "intencion": "menu|pedido|saludo|despedida|pago|entrega|detalles_producto|recomendacion|no_disponible|no_entendido|confirmar",
-  "items": [{{"producto":"nombre_exacto","cantidad":X}}],
-  "metodo": "transferencia|efectivo|",
-  "modo": "domicilio|tienda|",
-  "respuesta": "Texto conversacional con emojis"
-}}
-"""
-        resp = openai.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "Responde solo con JSON válido. Usa solo productos del catálogo proporcionado."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=400
-        )
-        
-        raw = resp.choices[0].message.content
-        resultado = json.loads(extraer_json(raw))
-
-        # Validar y sanitizar items
-        if "items" in resultado:
-            resultado["items"] = validar_items_llm(resultado["items"])
-
-        # Cachear respuesta
-        LLM_CACHE[texto_hash] = resultado
-        return resultado
-
-    except Exception as e:
-        logger.error(f"Error en LLM: {e}")
-        return {"intencion": "no_entendido", "respuesta": "Lo siento 😅 no logré entender bien. ¿Podrías decirlo de otra forma?"}
-
-# ========== Esquemas ==========
-class MensajeWeb(BaseModel):
-    texto: str
-    usuario_id: str
-
-# ========== Endpoints con manejo de errores ==========
-@app.post("/webhook/demo")
-async def webhook_demo(mensaje: MensajeWeb):
-    try:
-        uid = mensaje.usuario_id
-        texto = mensaje.texto.strip()
-
-        if not texto:
-            return {"respuesta": formatear_respuesta_web("¡Hola! 👋 ¿En qué puedo ayudarte hoy?"), "estado": "saludo"}
-
-        if uid not in ESTADOS:
-            ESTADOS[uid] = {
-                "items": [], 
-                "historia": [], 
-                "timestamp": time.time(), 
-                "metodo": None, 
-                "entrega": None
-            }
-        
-        estado = ESTADOS[uid]
-        estado["timestamp"] = time.time()
-
-        # 1) Detección rápida
-        deteccion = detectar_intencion_basica(texto)
-        if deteccion:
-            return _manejar_deteccion_rapida(deteccion, estado, uid)
-
-        # 2) Extracción de productos
-        items_detectados = extraer_productos_y_cantidades(texto)
-        if items_detectados:
-            return _manejar_items_detectados(items_detectados, estado)
-
-        # 3) LLM para casos complejos
-        resultado = interpretar_mensaje_con_LLM(texto, estado_actual=estado)
-        return _manejar_respuesta_llm(resultado, estado, uid, texto)
-
-    except Exception as e:
-        logger.error(f"Error en webhook_demo: {e}")
-        return {
-            "respuesta": formatear_respuesta_web("¡Ups! 😅 Tuve un problema. ¿Podrías intentarlo de nuevo?"),
-            "estado": "error"
-        }
-
-def _manejar_deteccion_rapida(deteccion: Dict, estado: Dict, uid: str) -> Dict:
-    intencion = deteccion["intencion"]
-    
-    if intencion == "saludo":
-        return {"respuesta": formatear_respuesta_web(deteccion["respuesta"]), "estado": "saludo"}
-    
-    elif intencion == "menu":
-        return {"respuesta": formatear_respuesta_web(deteccion["respuesta"]), "estado": "menu"}
-    
-    elif intencion == "no_disponible":
-        return {"respuesta": formatear_respuesta_web(deteccion["respuesta"]), "estado": "no_disponible"}
-    
-    elif intencion == "entrega":
-        estado["entrega"] = deteccion.get("modo")
-        return {"respuesta": formatear_respuesta_web(deteccion["respuesta"]), "estado": "entrega_confirmada"}
-    
-    elif intencion == "total":
-        if not estado.get("items"):
-            return {"respuesta": formatear_respuesta_web("Aún no tienes productos en tu pedido. ¿Te muestro el menú? 😊"), "estado": "total"}
-        
-        total = sum(i["cantidad"] * PRODUCTOS[i["producto"]]["precio"] for i in estado["items"])
-        desglose = "\n".join(
-            f"- {i['cantidad']} x {PRODUCTOS[i['producto']]['nombre']} = ${i['cantidad'] * PRODUCTOS[i['producto']]['precio']:,}"
-            for i in estado["items"]
-        )
-        return {
-            "respuesta": formatear_respuesta_web(f"🧮 Tu pedido va así:\n{desglose}\n\nTotal: ${total:,}\n¿Confirmamos o agregas algo más?"),
-            "estado": "total"
-        }
-    
-    elif intencion == "confirmar":
-        return _confirmar_pedido(estado, uid)
-    
-    elif intencion == "despedida":
-        return {"respuesta": formatear_respuesta_web(deteccion["respuesta"]), "estado": "despedida"}
-    
-    return {"respuesta": formatear_respuesta_web("No entendí 😅 ¿Podrías reformular?"), "estado": "no_entendido"}
-
-def _manejar_items_detectados(items_detectados: List[Dict], estado: Dict) -> Dict:
-    for nuevo in items_detectados:
-        existente = next((i for i in estado["items"] if i["producto"] == nuevo["producto"]), None)
-        if existente:
-            existente["cantidad"] += nuevo["cantidad"]
-        else:
-            estado["items"].append(nuevo)
-
-    total = sum(i["cantidad"] * PRODUCTOS[i["producto"]]["precio"] for i in estado["items"])
-    desglose = "\n".join([
-        f"- {i['cantidad']} x {PRODUCTOS[i['producto']]['nombre']} = ${i['cantidad'] * PRODUCTOS[i['producto']]['precio']:,}"
-        for i in estado["items"]
-    ])
-    
-    respuestas = [
-        f"🛒 ¡Perfecto! He actualizado tu pedido:\n{desglose}\n\nTotal: ${total:,}\n¿Quieres agregar algo más o pasamos al pago? 💳",
-        f"✅ ¡Agregado! Tu pedido:\n{desglose}\n\n💰 Total: ${total:,}\n¿Deseas algo adicional?",
-        f"🎯 ¡Excelente elección! Ahora tienes:\n{desglose}\n\n💵 Total: ${total:,}\n¿Necesitas algo más?"
-    ]
-    
-    return {"respuesta": formatear_respuesta_web(random.choice(respuestas)), "estado": "pedido"}
-
-def _manejar_respuesta_llm(resultado: Dict, estado: Dict, uid: str, texto: str) -> Dict:
-    intencion = resultado.get("intencion", "no_entendido")
-    respuesta_llm = resultado.get("respuesta", "")
-    
-    # Guardar historia
-    estado.setdefault("historia", []).append(f"Cliente: {texto}")
-    estado["historia"].append(f"Bot: {respuesta_llm}")
-    
-    if intencion == "pedido":
-        nuevos = validar_items_llm(resultado.get("items", []))
-        for n in nuevos:
-            existente = next((i for i in estado["items"] if i["producto"] == n["producto"]), None)
-            if existente:
-                existente["cantidad"] += n.get("cantidad", 1)
-            else:
-                estado["items"].append({"producto": n["producto"], "cantidad": n.get("cantidad", 1)})
-        
-        total = sum(i["cantidad"] * PRODUCTOS[i["producto"]]["precio"] for i in estado["items"])
-        desglose = "\n".join([
-            f"- {i['cantidad']} x {PRODUCTOS[i['producto']]['nombre']} = ${i['cantidad'] * PRODUCTOS[i['producto']]['precio']:,}"
-            for i in estado["items"]
-        ]) or "— vacío —"
-        
-        return {
-            "respuesta": formatear_respuesta_web(respuesta_llm or f"🛒 Pedido actualizado:\n{desglose}\n\nTotal: ${total:,}\n¿Deseas algo más?"),
-            "estado": "pedido"
-        }
-    
-    elif intencion == "pago":
-        metodo = resultado.get("metodo")
-        if metodo:
-            estado["metodo"] = metodo
-            return {"respuesta": formatear_respuesta_web(f"💳 Perfecto, registré *{metodo}*. ¿Confirmamos el pedido? ✅"), "estado": "pago"}
-        return {"respuesta": formatear_respuesta_web(respuesta_llm or "💳 Aceptamos transferencia o efectivo. ¿Cuál prefieres?"), "estado": "pago"}
-    
-    elif intencion == "entrega":
-        modo = resultado.get("modo")
-        if modo == "domicilio":
-            estado["entrega"] = "domicilio"
-            txt = f"📦 ¡Listo! Enviaremos tu pedido a domicilio. Tus datos serán tratados según nuestras políticas: {POLITICA_DATOS_LINK}. ¿Deseas confirmar ahora? ✅"
-            return {"respuesta": formatear_respuesta_web(txt), "estado": "entrega_confirmada"}
-        elif modo == "tienda":
-            estado["entrega"] = "tienda"
-            return {"respuesta": formatear_respuesta_web("🏪 Perfecto, lo prepararemos para *recoger en tienda*. ¿Quieres confirmar tu pedido ahora? ✅"), "estado": "entrega_confirmada"}
-        else:
-            return {"respuesta": formatear_respuesta_web("¿Prefieres *recoger en tienda* o *envío a domicilio*? 🏪🚚"), "estado": "entrega_pendiente"}
-    
-    elif intencion == "confirmar":
-        return _confirmar_pedido(estado, uid)
-    
-    else:
-        return {"respuesta": formatear_respuesta_web(respuesta_llm or "No te entendí bien 😅 ¿Podrías decirlo de otra forma?"), "estado": intencion}
-
-def _confirmar_pedido(estado: Dict, uid: str) -> Dict:
-    if not estado.get("items"):
-        return {"respuesta": formatear_respuesta_web("Aún no tienes productos en tu pedido. ¿Te muestro el menú? 😊"), "estado": "menu"}
-    
-    total = sum(i["cantidad"] * PRODUCTOS[i["producto"]]["precio"] for i in estado["items"])
-    ESTADOS.pop(uid, None)
-    
-    cierre = (
-        f"🎉 ¡Pedido confirmado! Total: ${total:,}<br>"
-        "En breve un asesor finalizará el proceso y coordinará la entrega. ¡Gracias por elegirnos! 🙌<br><br>"
-        "PS: Este es un *demo* de Tu Vendedor Inteligente (web/WhatsApp/IG). "
-        "¿Te gustaría tener uno así en tu empresa? 😉"
-    )
-    
-    return {"respuesta": formatear_respuesta_web(cierre), "estado": "confirmado"}
-
-@app.post("/webhook/demo/reset")
-async def reset(usuario_id: str):
-    ESTADOS.pop(usuario_id, None)
-    return {"status": "ok", "message": "Conversación reiniciada"}
-
-@app.get("/health")
-async def health():
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
-
-@app.get("/stats")
-async def stats():
-    return {
-        "usuarios_activos": len(ESTADOS),
-        "cache_llm": len(LLM_CACHE),
-        "productos": len(PRODUCTOS)
-    }
-
-@app.get("/")
-async def root():
-    return {
-        "message": "Tu Vendedor Inteligente está activo 🤖", 
-        "version": "3.0",
-        "estado": "optimizado"
-    }
-
-
-
+from fastapi import FastAPI, Header, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+from dotenv import load_dotenv
+import os, sys, json, time, logging, random, re, asyncio, math
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from types import MappingProxyType
+import hashlib
+import hmac
+import sqlite3
+import threading
+import unicodedata
+import uuid
+
+if TYPE_CHECKING:
+    import openai  # Se importa al calentar el arranque: es lo más caro de cargar
+
+# ========== Setup ==========
+load_dotenv()
+DIRECTORIO_APP = os.path.dirname(os.path.abspath(__file__))
+
+def ruta_de_la_app(ruta: str) -> str:
+    """Archivos que viajan con el código: una ruta relativa (también desde .env) se
+    resuelve junto a main.py y no desde el directorio de trabajo"""
+    return os.path.join(DIRECTORIO_APP, ruta)
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+LLM_MODELO = os.getenv("LLM_MODELO", "gpt-4o")
+LLM_TIMEOUT_S = float(os.getenv("LLM_TIMEOUT_S", "8"))  # Plazo total por mensaje (cola + llamada)
+LLM_MAX_CONCURRENTES = int(os.getenv("LLM_MAX_CONCURRENTES", "16"))  # Llamadas simultáneas al proveedor
+LLM_MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS", "300"))  # ~100 palabras + envoltorio JSON
+LLM_KEEPALIVE_S = float(os.getenv("LLM_KEEPALIVE_S", "60"))  # Conexiones ociosas al proveedor que se conservan abiertas
+LLM_CALENTAR_TIMEOUT_S = float(os.getenv("LLM_CALENTAR_TIMEOUT_S", "3"))  # Apertura de la conexión al arrancar (0 = no)
+LLM_MAX_EN_VUELO = int(os.getenv("LLM_MAX_EN_VUELO", "64"))  # Llamadas distintas en cola o en curso antes de rechazar
+CIRCUITO_VENTANA_S = float(os.getenv("CIRCUITO_VENTANA_S", "30"))  # Ventana móvil de llamadas observadas
+CIRCUITO_MIN_LLAMADAS = int(os.getenv("CIRCUITO_MIN_LLAMADAS", "10"))  # Mínimo en la ventana para decidir
+CIRCUITO_TASA_ERROR = float(os.getenv("CIRCUITO_TASA_ERROR", "0.5"))  # Errores/timeouts que abren el circuito
+CIRCUITO_LATENCIA_S = float(os.getenv("CIRCUITO_LATENCIA_S", "5"))  # Una llamada más lenta cuenta como lenta
+CIRCUITO_TASA_LENTAS = float(os.getenv("CIRCUITO_TASA_LENTAS", "0.8"))
+CIRCUITO_ESPERA_S = float(os.getenv("CIRCUITO_ESPERA_S", "15"))  # Abierto antes de probar de nuevo
+CIRCUITO_SONDAS = int(os.getenv("CIRCUITO_SONDAS", "2"))  # Llamadas de prueba en semiabierto
+LLM_CACHE_MAX_ENTRADAS = int(os.getenv("LLM_CACHE_MAX_ENTRADAS", "2000"))
+LLM_CACHE_TTL_S = float(os.getenv("LLM_CACHE_TTL_S", "3600"))
+LLM_CACHE_L2_DB = os.getenv("LLM_CACHE_L2_DB", "")  # SQLite compartido entre workers ("" = solo memoria)
+LLM_CACHE_L2_VOLCADO_S = float(os.getenv("LLM_CACHE_L2_VOLCADO_S", "0.05"))  # Escritura diferida del cache en disco
+LLM_CACHE_PRECARGA = int(os.getenv("LLM_CACHE_PRECARGA", "500"))  # Entradas más usadas que se suben a memoria al arrancar
+
+SESIONES_BACKEND = os.getenv("SESIONES_BACKEND", "memoria")  # memoria | sqlite
+SESIONES_DB = os.getenv("SESIONES_DB", "sesiones.db")
+SESION_TTL_S = float(os.getenv("SESION_TTL_S", "1800"))  # Inactividad antes de expirar
+SESIONES_BARRIDO_S = float(os.getenv("SESIONES_BARRIDO_S", "60"))
+SESIONES_VOLCADO_S = float(os.getenv("SESIONES_VOLCADO_S", "0.05"))  # Escritura diferida (sqlite)
+HISTORIA_MAX_TURNOS = int(os.getenv("HISTORIA_MAX_TURNOS", "6"))  # Turnos guardados por sesión
+HISTORIA_MAX_CARACTERES_TURNO = int(os.getenv("HISTORIA_MAX_CARACTERES_TURNO", "200"))  # Por mensaje guardado
+HISTORIA_TURNOS_PROMPT = int(os.getenv("HISTORIA_TURNOS_PROMPT", "2"))  # Turnos previos enviados al LLM (0 = ninguno)
+HISTORIA_TOKENS_PROMPT = int(os.getenv("HISTORIA_TOKENS_PROMPT", "150"))
+LOTE_MAX_MENSAJES = int(os.getenv("LOTE_MAX_MENSAJES", "500"))  # Tope de mensajes por llamada a /webhook/demo/batch
+LOTE_MAX_PARALELO = int(os.getenv("LOTE_MAX_PARALELO", "32"))  # Usuarios de un lote atendidos a la vez
+WS_INACTIVIDAD_S = float(os.getenv("WS_INACTIVIDAD_S", "300"))  # Se cierra la conexión sin mensajes del cliente
+WS_COLA_ENTRADA = int(os.getenv("WS_COLA_ENTRADA", "8"))  # Mensajes en espera por conexión antes de rechazar
+WS_COLA_SALIDA = int(os.getenv("WS_COLA_SALIDA", "32"))  # Eventos sin enviar antes de frenar el procesamiento
+WS_MAX_CARACTERES = int(os.getenv("WS_MAX_CARACTERES", "2000"))
+MAX_PENDIENTES_POR_USUARIO = int(os.getenv("MAX_PENDIENTES_POR_USUARIO", "3"))  # Mensajes en curso + en espera
+MAX_CANDADOS_SESION = int(os.getenv("MAX_CANDADOS_SESION", "10000"))
+
+PEDIDOS_ARCHIVO = os.getenv("PEDIDOS_ARCHIVO", "pedidos.jsonl")  # Pedidos confirmados, solo se anexa
+PEDIDOS_LOTE_MAX = int(os.getenv("PEDIDOS_LOTE_MAX", "500"))  # Pedidos por escritura (un fsync por lote)
+PEDIDOS_PAGINA_MAX = int(os.getenv("PEDIDOS_PAGINA_MAX", "1000"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")  # /orders y /debug/* exigen X-Admin-Token; sin definir no se exponen
+
+LENTAS_UMBRAL_MS = float(os.getenv("LENTAS_UMBRAL_MS", "0"))  # Mensajes más lentos se registran (0 = no)
+LENTAS_MAX = int(os.getenv("LENTAS_MAX", "200"))  # Últimas peticiones lentas que se conservan
+PERFILADOR_MAX_S = float(os.getenv("PERFILADOR_MAX_S", "0"))  # Duración máxima de /debug/perfil (0 = deshabilitado)
+PERFILADOR_INTERVALO_MS = float(os.getenv("PERFILADOR_INTERVALO_MS", "10"))
+
+CATALOGO_RUTA = ruta_de_la_app(os.getenv("CATALOGO_RUTA", "catalogo.json"))
+CATALOGO_RECARGA_S = float(os.getenv("CATALOGO_RECARGA_S", "5"))  # Cada cuánto se revisa el archivo (0 = sin recarga)
+PRODUCTOS_DISTANCIA_MAX = int(os.getenv("PRODUCTOS_DISTANCIA_MAX", "2"))  # Errores de tipeo tolerados (0 = solo exacto)
+
+CLASIFICADOR_FRASES = ruta_de_la_app(os.getenv("CLASIFICADOR_FRASES", "frases_intencion.json"))
+CLASIFICADOR_UMBRAL = float(os.getenv("CLASIFICADOR_UMBRAL", "0.8"))  # Por debajo se escala al LLM
+
+@asynccontextmanager
+async def ciclo_de_vida(app: FastAPI):
+    """Arranque medido por pasos y parada de las tareas de fondo. El calentamiento corre
+    después de aceptar conexiones: /health responde enseguida y /ready cuando termina."""
+    ARRANQUE["listo"] = False
+    ARRANQUE["pasos_ms"] = {"catalogo": CATALOGO_CARGA_MS}
+    inicio = time.perf_counter()
+    for nombre, paso in (("sesiones", ESTADOS.iniciar), ("cache_llm", LLM_CACHE.iniciar), ("pedidos", PEDIDOS.iniciar)):
+        t = time.perf_counter()
+        await paso()
+        ARRANQUE["pasos_ms"][nombre] = round((time.perf_counter() - t) * 1000, 1)
+    ARRANQUE["total_ms"] = round((time.perf_counter() - inicio) * 1000, 1)
+    tareas = [
+        asyncio.create_task(_calentar()),
+        asyncio.create_task(_barrer_sesiones_periodicamente()),
+        asyncio.create_task(_medir_lag_event_loop()),
+    ]
+    if CATALOGO_RECARGA_S > 0:
+        tareas.append(asyncio.create_task(_recargar_catalogo_periodicamente()))
+    try:
+        yield
+    finally:
+        ARRANQUE["listo"] = False
+        for tarea in tareas:
+            tarea.cancel()
+        await LLM_CACHE.detener()
+        await PEDIDOS.detener()
+        await ESTADOS.detener()
+
+app = FastAPI(lifespan=ciclo_de_vida)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("VendedorInteligente")
+
+# ========== Datos ==========
+# Productos, alias, cantidades en palabras y promociones viven en catalogo.json (ver Catálogo)
+
+DESPEDIDAS = [
+    "¡Gracias por tu visita! Hasta pronto 😊",
+    "¡Fue un placer ayudarte! ¡Vuelve pronto!",
+    "¡Nos vemos! 🌈 Que tengas un día delicioso.",
+    "¡Hasta luego! 🎯 Espero verte de nuevo pronto."
+]
+
+POLITICA_DATOS_LINK = "https://congelados-demo.com/politica-datos"
+
+RESPUESTA_NO_ENTENDIDO = {"intencion": "no_entendido", "respuesta": "Lo siento 😅 no logré entender bien. ¿Podrías decirlo de otra forma?"}
+RESPUESTA_OCUPADO = {"intencion": "ocupado", "respuesta": "Estamos atendiendo muchísimos mensajes en este momento 🙏 ¿Me lo repites en unos segundos? Mientras tanto puedes escribir *menú* para ver nuestros productos."}
+
+# ========== Métricas ==========
+LIMITES_LATENCIA_S = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ETAPAS = ("deteccion", "extraccion", "clasificador", "llm", "llm_proveedor", "respuesta")
+TIERS = ("rapida", "items", "local", "cache", "llm", "rechazo", "degradado", "error")
+INTERVALO_LAG_S = 0.5
+
+class Histograma:
+    """Histograma acumulativo con límites fijos (formato Prometheus)"""
+
+    __slots__ = ("limites", "conteos", "suma")
+
+    def __init__(self, limites: Tuple[float, ...] = LIMITES_LATENCIA_S):
+        self.limites = limites
+        self.conteos = [0] * (len(limites) + 1)
+        self.suma = 0.0
+
+    def observar(self, valor: float) -> None:
+        self.conteos[bisect_left(self.limites, valor)] += 1
+        self.suma += valor
+
+    def exponer(self, nombre: str, etiquetas: str = "") -> List[str]:
+        prefijo = f"{etiquetas}," if etiquetas else ""
+        lineas = []
+        acumulado = 0
+        for limite, n in zip(self.limites, self.conteos):
+            acumulado += n
+            lineas.append(f'{nombre}_bucket{{{prefijo}le="{limite}"}} {acumulado}')
+        acumulado += self.conteos[-1]
+        lineas.append(f'{nombre}_bucket{{{prefijo}le="+Inf"}} {acumulado}')
+        sufijo = f"{{{etiquetas}}}" if etiquetas else ""
+        lineas.append(f"{nombre}_sum{sufijo} {self.suma}")
+        lineas.append(f"{nombre}_count{sufijo} {acumulado}")
+        return lineas
+
+class MedicionPeticion:
+    """Tier y tiempos por etapa de un mensaje"""
+
+    __slots__ = ("inicio", "tier", "etapas")
+
+    def __init__(self):
+        self.inicio = time.perf_counter()
+        self.tier = "error"
+        self.etapas: List[Tuple[str, float]] = []
+
+class Metricas:
+    def __init__(self):
+        self.etapas = {e: Histograma() for e in ETAPAS}
+        self.peticiones = {t: Histograma() for t in TIERS}
+        self.errores: Dict[str, int] = {}
+        self.tokens = {"prompt": 0, "prompt_cacheados": 0, "completion": 0}
+        self.lag = Histograma()
+        self.lag_ultimo = 0.0
+
+    def error(self, tipo: str) -> None:
+        self.errores[tipo] = self.errores.get(tipo, 0) + 1
+
+    def exponer(self) -> str:
+        lineas = [
+            "# HELP vendedor_peticion_segundos Latencia por mensaje según el tier que lo resolvió",
+            "# TYPE vendedor_peticion_segundos histogram",
+        ]
+        for tier, h in self.peticiones.items():
+            lineas += h.exponer("vendedor_peticion_segundos", f'tier="{tier}"')
+        lineas += ["# HELP vendedor_etapa_segundos Latencia por etapa del pipeline",
+                   "# TYPE vendedor_etapa_segundos histogram"]
+        for etapa, h in self.etapas.items():
+            lineas += h.exponer("vendedor_etapa_segundos", f'etapa="{etapa}"')
+        lineas += ["# HELP vendedor_event_loop_lag_segundos Retraso del event loop frente al reloj",
+                   "# TYPE vendedor_event_loop_lag_segundos histogram"]
+        lineas += self.lag.exponer("vendedor_event_loop_lag_segundos")
+        lineas += ["# TYPE vendedor_errores_total counter"]
+        lineas += [f'vendedor_errores_total{{tipo="{t}"}} {n}' for t, n in self.errores.items()]
+        lineas += ["# TYPE vendedor_llm_tokens_total counter"]
+        lineas += [f'vendedor_llm_tokens_total{{tipo="{t}"}} {n}' for t, n in self.tokens.items()]
+        lineas += ["# TYPE vendedor_intenciones_total counter"]
+        lineas += [f'vendedor_intenciones_total{{regla="{r}"}} {n}' for r, n in ENRUTADOR.aciertos.items()]
+        cache = LLM_CACHE.estadisticas()
+        lineas += ["# TYPE vendedor_cache_llm_total counter"]
+        lineas += [f'vendedor_cache_llm_total{{resultado="{k}"}} {cache[k]}' for k in ("aciertos", "fallos", "desalojos", "expiraciones")]
+        lineas += [
+            "# TYPE vendedor_cache_llm_entradas gauge", f"vendedor_cache_llm_entradas {cache['entradas']}",
+            "# TYPE vendedor_llm_en_vuelo gauge", f"vendedor_llm_en_vuelo {len(_LLM_EN_VUELO)}",
+            "# TYPE vendedor_sesiones_activas gauge", f"vendedor_sesiones_activas {len(ESTADOS)}",
+            "# TYPE vendedor_circuito_llm_estado gauge",
+        ]
+        lineas += [f'vendedor_circuito_llm_estado{{estado="{e}"}} {int(CIRCUITO_LLM.estado == e)}'
+                   for e in ("cerrado", "abierto", "semiabierto")]
+        return "\n".join(lineas) + "\n"
+
+METRICAS = Metricas()
+_MEDICION: ContextVar[Optional[MedicionPeticion]] = ContextVar("medicion", default=None)
+
+def registrar_etapa(etapa: str, inicio: float) -> float:
+    """Observa la duración de una etapa y devuelve el instante actual"""
+    ahora = time.perf_counter()
+    METRICAS.etapas[etapa].observar(ahora - inicio)
+    medicion = _MEDICION.get()
+    if medicion is not None:
+        medicion.etapas.append((etapa, ahora - inicio))
+    return ahora
+
+def marcar_tier(tier: str) -> None:
+    medicion = _MEDICION.get()
+    if medicion is not None:
+        medicion.tier = tier
+
+# ========== Diagnóstico ==========
+PETICIONES_LENTAS: deque = deque(maxlen=LENTAS_MAX)
+DIAGNOSTICO_STATS = {"lentas": 0, "perfiles": 0}
+_PERFILANDO = threading.Lock()
+
+def registrar_si_lenta(medicion: MedicionPeticion, duracion: float, caracteres: int) -> None:
+    """Guarda tier y etapas de un mensaje que superó LENTAS_UMBRAL_MS.
+    Del texto solo se conserva el largo: puede tener datos personales."""
+    if LENTAS_UMBRAL_MS <= 0 or duracion * 1000 < LENTAS_UMBRAL_MS:
+        return
+    registro = {
+        "momento": datetime.now().isoformat(timespec="milliseconds"),
+        "tier": medicion.tier,
+        "total_ms": round(duracion * 1000, 1),
+        "caracteres": caracteres,
+        "etapas_ms": [[etapa, round(d * 1000, 1)] for etapa, d in medicion.etapas],
+    }
+    PETICIONES_LENTAS.append(registro)
+    DIAGNOSTICO_STATS["lentas"] += 1
+    logger.warning(f"Petición lenta: {json.dumps(registro, ensure_ascii=False)}")
+
+def _pila_colapsada(frame) -> str:
+    marcos = []
+    while frame is not None:
+        codigo = frame.f_code
+        marcos.append(f"{os.path.basename(codigo.co_filename)}:{codigo.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(marcos))
+
+def perfilar(segundos: float, intervalo_s: float) -> Tuple[Dict[str, int], int]:
+    """Muestrea las pilas de todos los hilos salvo el propio durante `segundos`.
+    Devuelve {"hilo;marco;...;marco": muestras} (formato colapsado de flamegraph) y el total de rondas."""
+    propio = threading.get_ident()
+    nombres: Dict[int, str] = {}
+    conteos: Dict[str, int] = {}
+    rondas = 0
+    fin = time.perf_counter() + segundos
+    while time.perf_counter() < fin:
+        for ident, frame in sys._current_frames().items():
+            if ident == propio:
+                continue
+            if ident not in nombres:
+                nombres = {h.ident: h.name for h in threading.enumerate()}
+            clave = f"{nombres.get(ident, ident)};{_pila_colapsada(frame)}"
+            conteos[clave] = conteos.get(clave, 0) + 1
+        rondas += 1
+        time.sleep(intervalo_s)
+    return conteos, rondas
+
+async def _medir_lag_event_loop() -> None:
+    while True:
+        inicio = time.perf_counter()
+        await asyncio.sleep(INTERVALO_LAG_S)
+        METRICAS.lag_ultimo = max(0.0, time.perf_counter() - inicio - INTERVALO_LAG_S)
+        METRICAS.lag.observar(METRICAS.lag_ultimo)
+
+# ========== Utilidades Mejoradas ==========
+def get_time_emoji() -> str:
+    hour = datetime.now().hour
+    if hour < 12: return "☀️"
+    if hour < 18: return "🌤️"
+    return "🌙"
+
+def saludo_dinamico() -> str:
+    """Saludo natural sin promociones forzadas"""
+    emoji_tiempo = get_time_emoji()
+    
+    saludos_base = [
+        f"¡Hola! {emoji_tiempo} Bienvenido a Congelados Deliciosos",
+        f"¡Qué gusto verte por aquí! 👋 {emoji_tiempo}", 
+        f"¡Hola! 🌟 Me da mucho gusto saludarte {emoji_tiempo}",
+        f"¡Bienvenido! 🥟 {emoji_tiempo} ¿Cómo estás?"
+    ]
+    
+    saludo = random.choice(saludos_base)
+    
+    # Ocasionalmente mencionar promoción suavemente (30% probabilidad)
+    if random.random() < 0.3:
+        promocion = random.choice(catalogo_actual().promociones)
+        return f"{saludo}. Por cierto, {promocion.lower()} ¿Te interesa?"
+    
+    return f"{saludo}. ¿En qué puedo ayudarte hoy?"
+
+def generar_respuesta_promociones() -> str:
+    """Respuesta dedicada para cuando preguntan por promociones"""
+    return catalogo_actual().texto_promociones
+
+def generar_respuesta_menu() -> str:
+    return catalogo_actual().texto_menu
+
+def generar_respuesta_recomendacion() -> str:
+    """Recomienda los productos populares del catálogo"""
+    return catalogo_actual().texto_recomendacion
+
+def formatear_respuesta_web(mensaje: str) -> str:
+    return mensaje.replace("\n", "<br>")
+
+# ========== Extracción de productos ==========
+_TOKEN_RE = re.compile(r"\d+|[a-záéíóúüñ]+")
+MAX_TOKENS_ENTRE_CANTIDAD_Y_PRODUCTO = 2  # "una docena de empanadas", "2 de las pizzas"
+# Una palabra corregida solo cuenta como producto cerca de uno de estos o de una cantidad
+VERBOS_PEDIDO = frozenset((
+    "quiero", "quisiera", "dame", "deme", "deseo", "necesito", "pido", "ponle", "ponme", "pon",
+    "agrega", "agregame", "agregar", "anade", "añade", "añademe", "suma", "sumale", "manda", "mandame",
+    "trae", "traeme", "regalame", "otra", "otro", "otras", "otros", "mas", "más",
+))
+
+_REGLAS_FONETICAS = (
+    (re.compile(r"ch"), "x"),
+    (re.compile(r"qu"), "k"),
+    (re.compile(r"c(?=[ei])"), "s"),
+    (re.compile(r"c"), "k"),
+    (re.compile(r"z"), "s"),
+    (re.compile(r"v"), "b"),
+    (re.compile(r"h"), ""),
+    (re.compile(r"(.)\1+"), r"\1"),  # "mozzarella" ~ "mozarela"
+)
+
+def plegar_fonetica(palabra: str) -> str:
+    """Sin tildes y con las confusiones ortográficas típicas del español unificadas"""
+    p = "".join(c for c in unicodedata.normalize("NFKD", palabra) if not unicodedata.combining(c))
+    for patron, reemplazo in _REGLAS_FONETICAS:
+        p = patron.sub(reemplazo, p)
+    return p
+
+def distancia_edicion(a: str, b: str, maximo: int) -> int:
+    """Damerau-Levenshtein (transposición de vecinas) con corte: devuelve maximo + 1 si lo supera"""
+    if abs(len(a) - len(b)) > maximo:
+        return maximo + 1
+    anterior2: List[int] = []
+    anterior = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        actual = [i] + [0] * len(b)
+        for j, cb in enumerate(b, 1):
+            actual[j] = min(anterior[j] + 1, actual[j - 1] + 1, anterior[j - 1] + (ca != cb))
+            if i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb:
+                actual[j] = min(actual[j], anterior2[j - 2] + 1)
+        if min(actual) > maximo:
+            return maximo + 1
+        anterior2, anterior = anterior, actual
+    return min(anterior[-1], maximo + 1)
+
+def _variantes_por_borrado(palabra: str, distancia: int) -> set:
+    variantes = frontera = {palabra}
+    for _ in range(distancia):
+        frontera = {v[:i] + v[i + 1:] for v in frontera for i in range(len(v))}
+        variantes = variantes | frontera
+    return variantes
+
+class IndiceDifuso:
+    """Índice de borrados estilo SymSpell sobre formas plegadas.
+
+    Cada palabra del vocabulario se indexa por todas sus variantes con hasta
+    distancia_max letras borradas; una consulta solo genera las suyas y verifica
+    los pocos candidatos que comparten alguna, sin recorrer el vocabulario.
+    """
+
+    __slots__ = ("distancia_max", "_exactas", "_borrados", "_memo")
+    MAX_MEMO = 4096
+
+    def __init__(self, palabras, distancia_max: int):
+        self.distancia_max = distancia_max
+        self._exactas: Dict[str, str] = {}  # forma plegada -> palabra del vocabulario
+        self._borrados: Dict[str, set] = {}
+        for palabra in palabras:
+            plegada = plegar_fonetica(palabra)
+            self._exactas.setdefault(plegada, palabra)
+            for variante in _variantes_por_borrado(plegada, distancia_max):
+                self._borrados.setdefault(variante, set()).add(plegada)
+        self._memo: Dict[str, Optional[str]] = {}
+
+    def distancia_permitida(self, n: int) -> int:
+        """Según el largo de la palabra más corta del par. Las cortas solo aceptan la forma
+        plegada exacta: a distancia 1 de "pisa" (pizza) están "pasa", "prisa", "bisa" (visa),
+        "misa", "pila"... Dos errores solo desde 9 letras: "pastilas" está a 2 de "pasteles"."""
+        return 0 if n < 6 else min(self.distancia_max, 1 if n < 9 else 2)
+
+    def corregir(self, palabra: str) -> Optional[str]:
+        if palabra in self._memo:
+            return self._memo[palabra]
+        if len(self._memo) >= self.MAX_MEMO:
+            self._memo.clear()
+        self._memo[palabra] = resultado = self._buscar(palabra)
+        return resultado
+
+    def _buscar(self, palabra: str) -> Optional[str]:
+        plegada = plegar_fonetica(palabra)
+        if plegada in self._exactas:
+            return self._exactas[plegada]
+        maximo = self.distancia_permitida(len(plegada))
+        if maximo == 0:
+            return None
+        candidatos = set()
+        for variante in _variantes_por_borrado(plegada, maximo):
+            candidatos |= self._borrados.get(variante, set())
+        mejor, mejor_d, empate = None, maximo + 1, False
+        for candidato in candidatos:
+            d = distancia_edicion(plegada, candidato, maximo)
+            if d > self.distancia_permitida(min(len(plegada), len(candidato))):
+                continue
+            if d < mejor_d:
+                mejor, mejor_d, empate = candidato, d, False
+            elif d == mejor_d:
+                empate = True
+        # Ante dos candidatos igual de cercanos no se adivina
+        return self._exactas[mejor] if mejor is not None and not empate else None
+
+class ExtractorProductos:
+    """Trie de tokens sobre alias y cantidades en palabras; recorre el mensaje en una pasada.
+    Los tokens desconocidos se corrigen contra el vocabulario de productos con IndiceDifuso."""
+
+    __slots__ = ("_trie", "_vocabulario", "_cantidades", "_difuso")
+
+    def __init__(self, alias: Dict[str, str], productos: Dict[str, Dict], num_palabras: Dict[str, int],
+                 distancia_max: int = PRODUCTOS_DISTANCIA_MAX):
+        self._trie: Dict = {}
+        self._vocabulario = set()
+        self._cantidades = {t for frase in num_palabras for t in _TOKEN_RE.findall(frase.lower())}
+        for frase, cantidad in num_palabras.items():
+            self._insertar(frase, ("cantidad", cantidad))
+        palabras_producto = set()
+        for frase, canon in list(alias.items()) + [(k, k) for k in productos]:
+            if canon in productos:
+                self._insertar(frase, ("producto", canon))
+                palabras_producto.update(t for t in _TOKEN_RE.findall(frase.lower()) if len(t) >= 3)
+        # Las cantidades solo se aceptan exactas: "siente" no debe leerse como "siete"
+        self._difuso = IndiceDifuso(sorted(palabras_producto), distancia_max)
+
+    def _insertar(self, frase: str, valor: Tuple[str, object]) -> None:
+        nodo = self._trie
+        for tok in _TOKEN_RE.findall(frase.lower()):
+            self._vocabulario.add(tok)
+            nodo = nodo.setdefault(tok, {})
+        nodo[None] = valor
+
+    def _tokens(self, texto: str) -> Tuple[List[str], List[bool]]:
+        """Tokens con las correcciones aplicadas y, en paralelo, cuáles se corrigieron"""
+        crudos = _TOKEN_RE.findall(texto.lower())
+        vocabulario, corregir = self._vocabulario, self._difuso.corregir
+        tokens, corregidos = [], []
+        for i, t in enumerate(crudos):
+            correccion = None
+            if not (t in vocabulario or t.isdigit() or len(t) < 3):
+                correccion = corregir(t)
+                # Sin contexto de pedido una palabra parecida no es un producto ("tengo prisa")
+                if correccion and not (len(crudos) == 1 or self._contexto_de_pedido(crudos, i)):
+                    correccion = None
+            tokens.append(correccion or t)
+            corregidos.append(correccion is not None)
+        return tokens, corregidos
+
+    def _contexto_de_pedido(self, tokens: List[str], i: int) -> bool:
+        """Hay una cantidad o un verbo de pedido justo después o a la distancia que
+        extraer() admite entre cantidad y producto ("2 dedos de mozarela")"""
+        vecinos = tokens[max(0, i - MAX_TOKENS_ENTRE_CANTIDAD_Y_PRODUCTO - 1):i] + tokens[i + 1:i + 2]
+        return any(v.isdigit() or v in self._cantidades or v in VERBOS_PEDIDO for v in vecinos)
+
+    def extraer(self, texto: str) -> List[Dict]:
+        tokens, corregidos = self._tokens(texto)
+        cantidades: Dict[str, int] = {}  # dict conserva el orden de aparición
+        pendiente: Optional[int] = None
+        distancia = 0
+        ultimo, desde_ultimo = None, 0
+        i, n = 0, len(tokens)
+        while i < n:
+            # Coincidencia más larga desde la posición i
+            nodo, valor, fin = self._trie, None, i
+            j = i
+            while j < n and tokens[j] in nodo:
+                nodo = nodo[tokens[j]]
+                j += 1
+                if None in nodo:
+                    valor, fin = nodo[None], j
+            if valor is None:
+                if tokens[i].isdigit():
+                    pendiente, distancia = int(tokens[i]), 0
+                else:
+                    distancia += 1
+                    if distancia > MAX_TOKENS_ENTRE_CANTIDAD_Y_PRODUCTO:
+                        pendiente = None
+                desde_ultimo += 1
+                i += 1
+                continue
+            tipo, dato = valor
+            if tipo == "cantidad":
+                pendiente, distancia = dato, 0
+                desde_ultimo += 1
+            else:
+                # Un tipeo corregido que repite el producto recién nombrado ("deditos dedtos de
+                # mozarela") es la misma mención; "pizza y pizza" escrito bien son dos
+                repetido = (dato == ultimo and pendiente is None and any(corregidos[i:fin])
+                            and desde_ultimo <= MAX_TOKENS_ENTRE_CANTIDAD_Y_PRODUCTO)
+                if not repetido:
+                    cantidades[dato] = cantidades.get(dato, 0) + (pendiente or 1)
+                pendiente = None
+                ultimo, desde_ultimo = dato, 0
+            i = fin
+        return [{"producto": p, "cantidad": c} for p, c in cantidades.items()]
+
+def extraer_productos_y_cantidades(texto: str) -> List[Dict]:
+    return catalogo_actual().extractor.extraer(texto)
+
+# ========== Catálogo ==========
+def construir_prompt_sistema(productos: Dict[str, Dict]) -> str:
+    """Parte estática del prompt: se arma una vez por catálogo y va primero para
+    que el proveedor pueda reutilizar el prefijo entre llamadas"""
+    catalogo = "\n".join(f"- {k}: ${p['precio']:,} ({p['descripcion']})" for k, p in productos.items())
+    return f"""Eres "Tu Vendedor Inteligente" de "Congelados Deliciosos": cálido y profesional.
+CATÁLOGO (id: precio, descripción). Usa SOLO estos productos:
+{catalogo}
+REGLAS: HISTORIAL (si viene) son los turnos previos, úsalo solo como contexto; si piden algo no disponible sugiere 1-3 alternativas del catálogo; máx 100 palabras, con emojis; termina con una pregunta amable.
+Responde SOLO con JSON válido:
+{{"intencion":"menu|pedido|saludo|despedida|pago|entrega|detalles_producto|recomendacion|no_disponible|no_entendido|confirmar","items":[{{"producto":"id","cantidad":1}}],"metodo":"transferencia|efectivo|","modo":"domicilio|tienda|","respuesta":"texto con emojis"}}"""
+
+def estimar_tokens(texto: str) -> int:
+    """Aproximación barata (~4 caracteres por token) para registrar tamaños"""
+    return max(1, len(texto) // 4)
+
+class Catalogo:
+    """Foto inmutable del catálogo con todo lo derivado ya construido.
+
+    Se arma completa en cada carga y se publica cambiando la referencia global,
+    así una petición en curso nunca mezcla datos de dos versiones.
+    """
+
+    __slots__ = ("productos", "alias", "num_palabras", "promociones", "extractor", "texto_menu",
+                 "texto_promociones", "texto_recomendacion", "texto_sugeridos", "texto_degradado", "prompt_sistema",
+                 "version", "version_cache")
+
+    def __init__(self, datos: Dict):
+        productos = {}
+        for k, p in datos["productos"].items():
+            if "nombre" not in p or not isinstance(p.get("precio"), int):
+                raise ValueError(f"Producto {k!r} sin nombre o con precio no entero")
+            productos[k] = {"descripcion": "", "categoria": "", **p}
+        alias = {a.lower(): canon for a, canon in datos.get("alias", {}).items() if canon in productos}
+        self.productos = MappingProxyType(productos)
+        self.alias = MappingProxyType(alias)
+        self.num_palabras = MappingProxyType(dict(datos.get("num_palabras", {})))
+        self.promociones = tuple(datos.get("promociones", ())) or ("🎉 ¡Pregunta por nuestras promociones del día!",)
+        self.extractor = ExtractorProductos(alias, productos, self.num_palabras)
+
+        lista = "\n".join(f"• {p['nombre']} - ${p['precio']:,}" for p in productos.values())
+        self.texto_menu = f"Aquí va nuestro menú 🧊:\n\n{lista}\n\n¿Te antoja algo? 😋"
+        lista = "\n".join(f"• {p}" for p in self.promociones)
+        self.texto_promociones = f"¡Claro! Tenemos estas promociones 🎉:\n\n{lista}\n\n¿Alguna te llama la atención? 😊"
+        populares = [p for p in productos.values() if p["categoria"] == "popular"] or list(productos.values())
+        lista = "\n".join(f"• {p['nombre']} - ${p['precio']:,}: {p['descripcion']}" for p in populares)
+        self.texto_recomendacion = f"¡Con gusto! ⭐ Los favoritos de nuestros clientes son:\n\n{lista}\n\n¿Te agrego alguno a tu pedido? 😋"
+        sugeridos = [k for k in datos.get("sugeridos", ()) if k in productos] or \
+            [k for k, p in productos.items() if p["categoria"] == "popular"][:3] or list(productos)[:3]
+        self.texto_sugeridos = sugeridos[0] if len(sugeridos) == 1 else f"{', '.join(sugeridos[:-1])} o {sugeridos[-1]}"
+        lista = "\n".join(f"• {p}" for p in self.promociones[:2])
+        self.texto_degradado = (
+            "En este momento no puedo responder eso con detalle 🙏 Te conecto con un asesor que te escribirá en breve.\n\n"
+            f"Promociones de hoy 🎉:\n{lista}\n\nMientras tanto, {self.texto_menu[0].lower()}{self.texto_menu[1:]}"
+        )
+        self.prompt_sistema = construir_prompt_sistema(productos)
+        self.version = hashlib.md5(json.dumps(datos, sort_keys=True).encode()).hexdigest()[:12]
+        # Respuestas cacheadas solo valen para el mismo catálogo, prompt y modelo
+        self.version_cache = hashlib.md5(f"{self.version}|{LLM_MODELO}|{self.prompt_sistema}".encode()).hexdigest()[:12]
+
+    def resolver_producto(self, nombre: str) -> Optional[str]:
+        """Id del catálogo para un nombre libre: id exacto, alias o con errores de tipeo"""
+        if nombre in self.productos:
+            return nombre
+        encontrados = self.extractor.extraer(nombre)
+        return encontrados[0]["producto"] if len(encontrados) == 1 else None
+
+def _firma_archivo(ruta: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(ruta)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+def cargar_catalogo(ruta: str) -> Catalogo:
+    with open(ruta, encoding="utf-8") as f:
+        catalogo = Catalogo(json.load(f))
+    logger.info(
+        f"Catálogo {catalogo.version}: {len(catalogo.productos)} productos, {len(catalogo.alias)} alias, "
+        f"prompt de sistema {len(catalogo.prompt_sistema)} caracteres (~{estimar_tokens(catalogo.prompt_sistema)} tokens)"
+    )
+    return catalogo
+
+_FIRMA_CATALOGO = _firma_archivo(CATALOGO_RUTA)
+_inicio_catalogo = time.perf_counter()
+CATALOGO = cargar_catalogo(CATALOGO_RUTA)
+CATALOGO_CARGA_MS = round((time.perf_counter() - _inicio_catalogo) * 1000, 1)
+CATALOGO_STATS = {"recargas": 0, "errores_recarga": 0}
+_CATALOGO_PETICION: ContextVar[Optional[Catalogo]] = ContextVar("catalogo", default=None)
+
+def catalogo_actual() -> Catalogo:
+    """Catálogo fijado al inicio de la petición en curso; fuera de una petición, el vigente"""
+    return _CATALOGO_PETICION.get() or CATALOGO
+
+async def _recargar_catalogo_periodicamente() -> None:
+    """Revisa mtime/tamaño del archivo y publica una nueva foto si cambió.
+    Si el archivo nuevo es inválido se mantiene la versión anterior."""
+    global CATALOGO, _FIRMA_CATALOGO
+    while True:
+        await asyncio.sleep(CATALOGO_RECARGA_S)
+        firma = _firma_archivo(CATALOGO_RUTA)
+        if firma is None or firma == _FIRMA_CATALOGO:
+            continue
+        _FIRMA_CATALOGO = firma
+        try:
+            # Con miles de SKUs la construcción no debe frenar el event loop
+            nuevo = await asyncio.to_thread(cargar_catalogo, CATALOGO_RUTA)
+        except Exception as e:
+            CATALOGO_STATS["errores_recarga"] += 1
+            logger.error(f"Catálogo inválido, se mantiene la versión {CATALOGO.version}: {e}")
+            continue
+        CATALOGO = nuevo
+        CATALOGO_STATS["recargas"] += 1
+
+_CERCO_INICIO_RE = re.compile(r"^```(?:json)?\s*")
+_CERCO_FIN_RE = re.compile(r"\s*```$")
+_OBJETO_JSON_RE = re.compile(r"\{.*\}", re.DOTALL)
+_PALABRA_RE = re.compile(r"\w+")
+
+def extraer_json(texto: str) -> str:
+    s = texto.strip()
+    if s.startswith("```"):
+        s = _CERCO_INICIO_RE.sub("", s)
+        s = _CERCO_FIN_RE.sub("", s)
+    m = _OBJETO_JSON_RE.search(s)
+    return m.group(0) if m else s
+
+def validar_items_llm(items: List[Dict]) -> List[Dict]:
+    validos = []
+    catalogo = catalogo_actual()
+    for item in items or []:
+        producto = catalogo.resolver_producto(str(item["producto"])) if isinstance(item, dict) and "producto" in item else None
+        if producto:
+            cantidad = max(1, int(item.get("cantidad", 1)))
+            validos.append({"producto": producto, "cantidad": cantidad})
+        else:
+            logger.warning(f"Item inválido del LLM: {item}")
+    return validos
+
+def generar_hash_texto(texto: str) -> str:
+    """Genera hash para cache de LLM"""
+    return hashlib.md5(texto.encode()).hexdigest()
+
+def normalizar_texto(texto: str) -> str:
+    """Minúsculas, sin tildes ni puntuación y con espacios colapsados"""
+    t = unicodedata.normalize("NFKD", texto.lower())
+    t = "".join(c for c in t if not unicodedata.combining(c))
+    return " ".join(_PALABRA_RE.findall(t))
+
+def huella_carrito(carrito: Optional["Carrito"]) -> str:
+    """Representación compacta y ordenada del pedido actual"""
+    return carrito.huella() if carrito else ""
+
+def clave_cache_llm(texto_usuario: str, estado_actual: Optional[Dict] = None) -> str:
+    """Clave de cache: versión de catálogo/prompt + texto normalizado + huella del carrito
+    + los turnos previos que recibiría el LLM"""
+    carrito = estado_actual.get("carrito") if estado_actual else None
+    return generar_hash_texto(
+        f"{catalogo_actual().version_cache}|{normalizar_texto(texto_usuario)}|{huella_carrito(carrito)}"
+        f"|{huella_contexto(estado_actual)}"
+    )
+
+# ========== Cache LLM ==========
+def conectar_sqlite(ruta: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(ruta, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+class CacheSQLite:
+    """Segundo nivel del cache LLM en SQLite (WAL), compartido por los workers del host.
+
+    Las lecturas son búsquedas por clave primaria; escrituras y conteo de aciertos
+    se acumulan y se vuelcan por lotes fuera del event loop.
+    """
+
+    def __init__(self, ruta: str, intervalo_volcado: float):
+        self.intervalo_volcado = intervalo_volcado
+        self._lectura = conectar_sqlite(ruta)
+        self._escritura = conectar_sqlite(ruta)
+        self._lock_escritura = threading.Lock()
+        self._escritura.execute(
+            "CREATE TABLE IF NOT EXISTS cache_llm (clave TEXT PRIMARY KEY, version TEXT NOT NULL, valor TEXT NOT NULL, "
+            "expira REAL NOT NULL, aciertos INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._escritura.execute("CREATE INDEX IF NOT EXISTS idx_cache_llm_version ON cache_llm (version, aciertos)")
+        self._pendientes: Dict[str, Tuple[str, str, float]] = {}  # clave -> (version, valor, expira)
+        self._aciertos: Dict[str, int] = {}
+        self._tarea: Optional[asyncio.Task] = None
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, clave: str) -> Optional[Tuple[float, Dict]]:
+        """(expira en tiempo de pared, valor) o None"""
+        pendiente = self._pendientes.get(clave)
+        if pendiente is not None:
+            fila = pendiente[1:]
+        else:
+            fila = self._lectura.execute("SELECT valor, expira FROM cache_llm WHERE clave = ?", (clave,)).fetchone()
+        if fila is None or fila[1] <= time.time():
+            self.fallos += 1
+            return None
+        self.aciertos += 1
+        self.anotar_acierto(clave)
+        return fila[1], json.loads(fila[0])
+
+    def anotar_acierto(self, clave: str) -> None:
+        """Cuenta el uso (también los aciertos en memoria) para elegir qué precargar"""
+        self._aciertos[clave] = self._aciertos.get(clave, 0) + 1
+
+    def guardar(self, clave: str, version: str, valor: Dict, expira: float) -> None:
+        self._pendientes[clave] = (version, json.dumps(valor, ensure_ascii=False), expira)
+
+    def mas_usadas(self, version: str, limite: int) -> List[Tuple[str, float, Dict]]:
+        filas = self._lectura.execute(
+            "SELECT clave, expira, valor FROM cache_llm WHERE version = ? AND expira > ? ORDER BY aciertos DESC LIMIT ?",
+            (version, time.time(), limite)
+        ).fetchall()
+        return [(clave, expira, json.loads(valor)) for clave, expira, valor in filas]
+
+    def _escribir(self, filas: List[Tuple[str, str, str, float]], aciertos: List[Tuple[int, str]]) -> None:
+        with self._lock_escritura:
+            self._escritura.execute("BEGIN")
+            try:
+                self._escritura.executemany(
+                    "INSERT INTO cache_llm (clave, version, valor, expira) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(clave) DO UPDATE SET version = excluded.version, valor = excluded.valor, expira = excluded.expira",
+                    filas
+                )
+                self._escritura.executemany("UPDATE cache_llm SET aciertos = aciertos + ? WHERE clave = ?", aciertos)
+                self._escritura.execute("COMMIT")
+            except Exception:
+                self._escritura.execute("ROLLBACK")
+                raise
+
+    def _borrar_vencidas(self) -> int:
+        with self._lock_escritura:
+            return self._escritura.execute("DELETE FROM cache_llm WHERE expira <= ?", (time.time(),)).rowcount
+
+    async def volcar(self) -> None:
+        if not self._pendientes and not self._aciertos:
+            return
+        pendientes, self._pendientes = self._pendientes, {}
+        aciertos, self._aciertos = self._aciertos, {}
+        filas = [(clave, *datos) for clave, datos in pendientes.items()]
+        try:
+            await asyncio.to_thread(self._escribir, filas, [(n, clave) for clave, n in aciertos.items()])
+        except Exception as e:
+            # Es un cache: si el disco falla se pierde el lote, no la respuesta
+            logger.error(f"Error volcando cache LLM: {e}")
+
+    async def _volcar_periodicamente(self) -> None:
+        while True:
+            await asyncio.sleep(self.intervalo_volcado)
+            await self.volcar()
+
+    async def iniciar(self) -> None:
+        borradas = await asyncio.to_thread(self._borrar_vencidas)
+        if borradas:
+            logger.info(f"Cache LLM en disco: {borradas} entradas vencidas eliminadas")
+        self._tarea = asyncio.create_task(self._volcar_periodicamente())
+
+    async def detener(self) -> None:
+        if self._tarea:
+            self._tarea.cancel()
+        await self.volcar()
+
+class CacheLLM:
+    """Cache LRU con expiración por TTL para respuestas del LLM, opcionalmente sobre un segundo nivel en disco"""
+
+    def __init__(self, max_entradas: int, ttl_s: float, segundo_nivel: Optional[CacheSQLite] = None):
+        self.max_entradas = max_entradas
+        self.ttl_s = ttl_s
+        self.segundo_nivel = segundo_nivel
+        self._datos: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        self.aciertos = 0
+        self.fallos = 0
+        self.desalojos = 0
+        self.expiraciones = 0
+        self.precargadas = 0
+
+    def obtener(self, clave: str) -> Optional[Dict]:
+        entrada = self._datos.get(clave)
+        if entrada is not None and entrada[0] <= time.monotonic():
+            del self._datos[clave]
+            self.expiraciones += 1
+            entrada = None
+        if entrada is None:
+            # Lo que otro worker o un proceso anterior ya pagó se sube a memoria
+            if self.segundo_nivel is not None:
+                encontrada = self.segundo_nivel.obtener(clave)
+                if encontrada is not None:
+                    expira, valor = encontrada
+                    self._insertar(clave, valor, time.monotonic() + (expira - time.time()))
+                    self.aciertos += 1
+                    return valor
+            self.fallos += 1
+            return None
+        self._datos.move_to_end(clave)
+        self.aciertos += 1
+        if self.segundo_nivel is not None:
+            self.segundo_nivel.anotar_acierto(clave)
+        return entrada[1]
+
+    def guardar(self, clave: str, valor: Dict, version: str = "") -> None:
+        self._insertar(clave, valor, time.monotonic() + self.ttl_s)
+        if self.segundo_nivel is not None:
+            self.segundo_nivel.guardar(clave, version, valor, time.time() + self.ttl_s)
+
+    def _insertar(self, clave: str, valor: Dict, expira: float) -> None:
+        ahora = time.monotonic()
+        self._datos[clave] = (expira, valor)
+        self._datos.move_to_end(clave)
+        # Primero descartar lo vencido más antiguo, luego respetar el tope
+        while self._datos:
+            primera = next(iter(self._datos))
+            if self._datos[primera][0] > ahora:
+                break
+            del self._datos[primera]
+            self.expiraciones += 1
+        while len(self._datos) > self.max_entradas:
+            self._datos.popitem(last=False)
+            self.desalojos += 1
+
+    async def iniciar(self) -> None:
+        if self.segundo_nivel is None:
+            return
+        await self.segundo_nivel.iniciar()
+        version = CATALOGO.version_cache
+        calientes = await asyncio.to_thread(self.segundo_nivel.mas_usadas, version, min(LLM_CACHE_PRECARGA, self.max_entradas))
+        # De menos a más usada, para que las más calientes queden al final del LRU
+        for clave, expira, valor in reversed(calientes):
+            self._insertar(clave, valor, time.monotonic() + (expira - time.time()))
+        self.precargadas = len(calientes)
+        logger.info(f"Cache LLM: {self.precargadas} entradas precargadas desde disco (versión {version})")
+
+    async def detener(self) -> None:
+        if self.segundo_nivel is not None:
+            await self.segundo_nivel.detener()
+
+    def __len__(self) -> int:
+        return len(self._datos)
+
+    def estadisticas(self) -> Dict:
+        consultas = self.aciertos + self.fallos
+        return {
+            "entradas": len(self._datos),
+            "max_entradas": self.max_entradas,
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "desalojos": self.desalojos,
+            "expiraciones": self.expiraciones,
+            "tasa_aciertos": round(self.aciertos / consultas, 3) if consultas else 0.0,
+            "precargadas": self.precargadas,
+            "disco": {"aciertos": self.segundo_nivel.aciertos, "fallos": self.segundo_nivel.fallos}
+            if self.segundo_nivel is not None else None,
+        }
+
+LLM_CACHE = CacheLLM(
+    LLM_CACHE_MAX_ENTRADAS, LLM_CACHE_TTL_S,
+    CacheSQLite(LLM_CACHE_L2_DB, LLM_CACHE_L2_VOLCADO_S) if LLM_CACHE_L2_DB else None
+)
+
+# ========== Carrito ==========
+class Carrito:
+    """Pedido indexado por producto con total incremental.
+
+    El precio y el nombre se congelan al agregar la línea; el desglose se
+    renderiza una vez y se reutiliza hasta el siguiente cambio.
+    """
+
+    __slots__ = ("_lineas", "total", "_desglose", "_huella")
+
+    def __init__(self):
+        self._lineas: Dict[str, list] = {}  # producto -> [cantidad, precio, nombre]
+        self.total = 0
+        self._desglose: Optional[str] = None
+        self._huella: Optional[str] = None
+
+    def agregar(self, producto: str, cantidad: int = 1) -> None:
+        linea = self._lineas.get(producto)
+        if linea is None:
+            info = catalogo_actual().productos[producto]
+            linea = self._lineas[producto] = [0, info["precio"], info["nombre"]]
+        linea[0] += cantidad
+        self.total += cantidad * linea[1]
+        self._desglose = self._huella = None
+
+    def agregar_items(self, items: List[Dict]) -> None:
+        for item in items:
+            self.agregar(item["producto"], item.get("cantidad", 1))
+
+    def desglose(self) -> str:
+        if self._desglose is None:
+            self._desglose = "\n".join(
+                f"- {cantidad} x {nombre} = ${cantidad * precio:,}"
+                for cantidad, precio, nombre in self._lineas.values()
+            )
+        return self._desglose
+
+    def huella(self) -> str:
+        if self._huella is None:
+            self._huella = ",".join(sorted(f"{p}:{l[0]}" for p, l in self._lineas.items()))
+        return self._huella
+
+    def items(self) -> List[Dict]:
+        return [{"producto": p, "cantidad": l[0]} for p, l in self._lineas.items()]
+
+    def a_lista(self) -> List[Dict]:
+        """Forma serializable, con el precio congelado de cada línea"""
+        return [{"producto": p, "cantidad": l[0], "precio": l[1], "nombre": l[2]} for p, l in self._lineas.items()]
+
+    @classmethod
+    def desde_lista(cls, lineas: List[Dict]) -> "Carrito":
+        carrito = cls()
+        productos = catalogo_actual().productos
+        for linea in lineas:
+            producto = linea.get("producto")
+            info = productos.get(producto)
+            # Las líneas guardadas conservan su precio aunque el catálogo haya cambiado
+            if "precio" in linea and "nombre" in linea:
+                precio, nombre = linea["precio"], linea["nombre"]
+            elif info is not None:
+                precio, nombre = info["precio"], info["nombre"]
+            else:
+                continue
+            carrito._lineas[producto] = [linea["cantidad"], precio, nombre]
+            carrito.total += linea["cantidad"] * precio
+        return carrito
+
+    def __len__(self) -> int:
+        return len(self._lineas)
+
+# ========== Historia ==========
+class Historia:
+    """Últimos turnos (cliente, bot) en un buffer circular con tope de turnos y de caracteres"""
+
+    __slots__ = ("_turnos",)
+
+    def __init__(self, turnos=()):
+        self._turnos: deque = deque(turnos, maxlen=HISTORIA_MAX_TURNOS)
+
+    def agregar(self, cliente: str, bot: str) -> None:
+        self._turnos.append((cliente[:HISTORIA_MAX_CARACTERES_TURNO], bot[:HISTORIA_MAX_CARACTERES_TURNO]))
+
+    def recientes(self, max_turnos: int, max_tokens: int) -> List[Tuple[str, str]]:
+        """Los turnos más recientes que entren en el presupuesto, en orden cronológico"""
+        elegidos: List[Tuple[str, str]] = []
+        usados = 0
+        for cliente, bot in list(self._turnos)[::-1][:max_turnos]:
+            usados += estimar_tokens(cliente) + estimar_tokens(bot)
+            if usados > max_tokens:
+                break
+            elegidos.append((cliente, bot))
+        return elegidos[::-1]
+
+    def contexto(self, max_turnos: int, max_tokens: int) -> str:
+        return "\n".join(f"Cliente: {c}\nBot: {b}" for c, b in self.recientes(max_turnos, max_tokens))
+
+    def a_lista(self) -> List[List[str]]:
+        return [list(t) for t in self._turnos]
+
+    @classmethod
+    def desde_lista(cls, datos: List) -> "Historia":
+        # Formato anterior: ["Cliente: ...", "Bot: ...", ...] sin tope
+        if datos and isinstance(datos[0], str):
+            datos = [(c.removeprefix("Cliente: "), b.removeprefix("Bot: ")) for c, b in zip(datos[::2], datos[1::2])]
+        historia = cls()
+        for cliente, bot in datos:
+            historia.agregar(cliente, bot)
+        return historia
+
+    def __len__(self) -> int:
+        return len(self._turnos)
+
+def contexto_llm(estado: Optional[Dict]) -> str:
+    historia = estado.get("historia") if estado else None
+    if not historia or HISTORIA_TURNOS_PROMPT <= 0:
+        return ""
+    return historia.contexto(HISTORIA_TURNOS_PROMPT, HISTORIA_TOKENS_PROMPT)
+
+def huella_contexto(estado: Optional[Dict]) -> str:
+    """Lo que dijo el cliente en los turnos que van al prompt. Las respuestas del bot
+    quedan fuera: varían al azar (saludos, plantillas) sin cambiar el sentido"""
+    historia = estado.get("historia") if estado else None
+    if not historia or HISTORIA_TURNOS_PROMPT <= 0:
+        return ""
+    turnos = historia.recientes(HISTORIA_TURNOS_PROMPT, HISTORIA_TOKENS_PROMPT)
+    return "/".join(normalizar_texto(cliente) for cliente, _ in turnos)
+
+# ========== Sesiones ==========
+def nueva_sesion() -> Dict:
+    return {
+        "carrito": Carrito(),
+        "historia": Historia(),
+        "timestamp": time.time(),
+        "metodo": None,
+        "entrega": None
+    }
+
+def serializar_sesion(estado: Dict) -> str:
+    # Las claves con "_" son metadatos del almacén (revisión leída), no datos de la sesión
+    datos = {k: v for k, v in estado.items() if not k.startswith("_")}
+    return json.dumps({**datos, "carrito": estado["carrito"].a_lista(), "historia": estado["historia"].a_lista()})
+
+def deserializar_sesion(datos: str) -> Dict:
+    estado = json.loads(datos)
+    # Las filas anteriores al Carrito guardaban la lista en "items"
+    estado["carrito"] = Carrito.desde_lista(estado.pop("items", None) or estado.get("carrito") or [])
+    estado["historia"] = Historia.desde_lista(estado.get("historia") or [])
+    return estado
+
+def _turnos_nuevos(base: List, propia: List) -> List:
+    """Turnos de `propia` posteriores a los de `base`, aunque el buffer haya rotado"""
+    for i in range(len(base) + 1):
+        resto = base[i:]
+        if propia[:len(resto)] == resto:
+            return propia[len(resto):]
+    return propia
+
+def fusionar_sesion(base: Optional[str], propia: str, vigente: Optional[str]) -> str:
+    """Reaplica sobre `vigente` (lo que guardó otro worker) lo que este cambió desde `base`.
+
+    Los cambios de un mensaje son aditivos: unidades agregadas al carrito, turnos
+    nuevos en la historia y método/entrega elegidos.
+    """
+    anterior = deserializar_sesion(base) if base else nueva_sesion()
+    nuestra = deserializar_sesion(propia)
+    resultado = deserializar_sesion(vigente) if vigente else nueva_sesion()
+
+    cantidades_base = {l["producto"]: l["cantidad"] for l in anterior["carrito"].a_lista()}
+    lineas = {l["producto"]: l for l in resultado["carrito"].a_lista()}
+    for linea in nuestra["carrito"].a_lista():
+        agregadas = linea["cantidad"] - cantidades_base.get(linea["producto"], 0)
+        if agregadas <= 0:
+            continue
+        if linea["producto"] in lineas:
+            lineas[linea["producto"]]["cantidad"] += agregadas
+        else:
+            lineas[linea["producto"]] = {**linea, "cantidad": agregadas}
+    resultado["carrito"] = Carrito.desde_lista(list(lineas.values()))
+
+    for cliente, bot in _turnos_nuevos(anterior["historia"].a_lista(), nuestra["historia"].a_lista()):
+        resultado["historia"].agregar(cliente, bot)
+    for clave in ("metodo", "entrega"):
+        if nuestra.get(clave) != anterior.get(clave):
+            resultado[clave] = nuestra.get(clave)
+    resultado["timestamp"] = max(resultado["timestamp"], nuestra["timestamp"])
+    return serializar_sesion(resultado)
+
+class AlmacenSesiones(ABC):
+    """Interfaz del almacén de sesiones usado por webhook_demo"""
+
+    @abstractmethod
+    def obtener(self, uid: str) -> Dict:
+        """Devuelve la sesión del usuario, creándola si no existe"""
+
+    @abstractmethod
+    def guardar(self, uid: str, estado: Dict) -> None:
+        ...
+
+    @abstractmethod
+    def eliminar(self, uid: str) -> None:
+        ...
+
+    @abstractmethod
+    async def barrer(self, ttl_s: float) -> int:
+        """Elimina sesiones inactivas hace más de ttl_s; devuelve cuántas"""
+
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    async def iniciar(self) -> None:
+        pass
+
+    async def detener(self) -> None:
+        pass
+
+class AlmacenMemoria(AlmacenSesiones):
+    """Sesiones en un dict del proceso (un solo worker)"""
+
+    def __init__(self):
+        self._sesiones: Dict[str, Dict] = {}
+
+    def obtener(self, uid: str) -> Dict:
+        estado = self._sesiones.get(uid)
+        if estado is None:
+            estado = self._sesiones[uid] = nueva_sesion()
+        return estado
+
+    def guardar(self, uid: str, estado: Dict) -> None:
+        self._sesiones[uid] = estado
+
+    def eliminar(self, uid: str) -> None:
+        self._sesiones.pop(uid, None)
+
+    async def barrer(self, ttl_s: float) -> int:
+        limite = time.time() - ttl_s
+        vencidas = [uid for uid, e in self._sesiones.items() if e["timestamp"] < limite]
+        for uid in vencidas:
+            del self._sesiones[uid]
+        return len(vencidas)
+
+    def __len__(self) -> int:
+        return len(self._sesiones)
+
+class AlmacenSQLite(AlmacenSesiones):
+    """Sesiones en SQLite (WAL) compartidas entre workers, con escritura diferida por lotes.
+
+    Cada fila lleva una revisión. Al volcar se compara con la leída: si otro worker
+    guardó entre medio, los cambios de este se fusionan sobre los suyos en lugar de
+    pisarlos (ver fusionar_sesion).
+    """
+
+    def __init__(self, ruta: str, intervalo_volcado: float):
+        self.intervalo_volcado = intervalo_volcado
+        self._lectura = conectar_sqlite(ruta)
+        self._escritura = conectar_sqlite(ruta)
+        self._lock_escritura = threading.Lock()
+        self._escritura.execute(
+            "CREATE TABLE IF NOT EXISTS sesiones (uid TEXT PRIMARY KEY, datos TEXT NOT NULL, actualizado REAL NOT NULL, "
+            "revision TEXT NOT NULL DEFAULT '')"
+        )
+        columnas = {fila[1] for fila in self._escritura.execute("PRAGMA table_info(sesiones)")}
+        if "revision" not in columnas:  # Tablas creadas antes de la revisión
+            self._escritura.execute("ALTER TABLE sesiones ADD COLUMN revision TEXT NOT NULL DEFAULT ''")
+        self._escritura.execute("CREATE INDEX IF NOT EXISTS idx_sesiones_actualizado ON sesiones (actualizado)")
+        # uid -> estado pendiente de escribir (None = borrar)
+        self._pendientes: Dict[str, Optional[Dict]] = {}
+        self._en_vuelo: Dict[str, Optional[Dict]] = {}
+        self._tarea: Optional[asyncio.Task] = None
+        self.fusiones = 0
+        # Conteo para /stats y /metrics sin consultar desde el event loop: lo ajusta cada
+        # volcado y lo recalcula el barrido (incluye lo que escriben otros workers)
+        self._total = self._contar()
+
+    def _contar(self) -> int:
+        return self._escritura.execute("SELECT COUNT(*) FROM sesiones").fetchone()[0]
+
+    def obtener(self, uid: str) -> Dict:
+        # Lo pendiente en este worker manda sobre lo que haya en disco
+        for capa in (self._pendientes, self._en_vuelo):
+            if uid in capa:
+                return capa[uid] or nueva_sesion()
+        fila = self._lectura.execute("SELECT datos, revision FROM sesiones WHERE uid = ?", (uid,)).fetchone()
+        if not fila:
+            return nueva_sesion()
+        estado = deserializar_sesion(fila[0])
+        # Revisión y contenido leídos: base del compare-and-swap al volcar
+        estado["_revision"], estado["_base"] = fila[1], fila[0]
+        return estado
+
+    def guardar(self, uid: str, estado: Dict) -> None:
+        self._pendientes[uid] = estado
+
+    def eliminar(self, uid: str) -> None:
+        self._pendientes[uid] = None
+
+    def _borrar_vencidas(self, limite: float) -> int:
+        with self._lock_escritura:
+            borradas = self._escritura.execute("DELETE FROM sesiones WHERE actualizado < ?", (limite,)).rowcount
+            self._total = self._contar()
+            return borradas
+
+    async def barrer(self, ttl_s: float) -> int:
+        return await asyncio.to_thread(self._borrar_vencidas, time.time() - ttl_s)
+
+    def __len__(self) -> int:
+        return self._total
+
+    def _escribir(self, filas: List[Tuple[str, str, float, str, Optional[str]]], borrados: List[str]) -> Dict[str, str]:
+        """Compare-and-swap por revisión dentro de una transacción IMMEDIATE (bloquea a los
+        demás escritores). Devuelve uid -> revisión nueva de las filas escritas sin conflicto."""
+        revisiones: Dict[str, str] = {}
+        nuevas = 0
+        with self._lock_escritura:
+            self._escritura.execute("BEGIN IMMEDIATE")
+            try:
+                for uid, datos, actualizado, revision, base in filas:
+                    fila = self._escritura.execute("SELECT datos, revision FROM sesiones WHERE uid = ?", (uid,)).fetchone()
+                    if (fila[1] if fila else "") != revision:
+                        datos = fusionar_sesion(base, datos, fila[0] if fila else None)
+                        self.fusiones += 1
+                        logger.info(f"Sesión {uid} guardada por otro worker: cambios fusionados")
+                    nueva = uuid.uuid4().hex
+                    self._escritura.execute(
+                        "INSERT INTO sesiones (uid, datos, actualizado, revision) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT(uid) DO UPDATE SET datos = excluded.datos, actualizado = excluded.actualizado, "
+                        "revision = excluded.revision",
+                        (uid, datos, actualizado, nueva)
+                    )
+                    if fila is None or fila[1] == revision:
+                        revisiones[uid] = nueva
+                    nuevas += fila is None
+                borradas = self._escritura.executemany(
+                    "DELETE FROM sesiones WHERE uid = ?", [(uid,) for uid in borrados]
+                ).rowcount
+                self._escritura.execute("COMMIT")
+            except Exception:
+                self._escritura.execute("ROLLBACK")
+                raise
+            self._total += nuevas - max(borradas, 0)
+        return revisiones
+
+    async def volcar(self) -> None:
+        """Escribe el lote pendiente fuera del event loop"""
+        if not self._pendientes:
+            return
+        self._en_vuelo, self._pendientes = self._pendientes, {}
+        filas = [(uid, serializar_sesion(e), e["timestamp"], e.get("_revision", ""), e.get("_base"))
+                 for uid, e in self._en_vuelo.items() if e is not None]
+        borrados = [uid for uid, e in self._en_vuelo.items() if e is None]
+        try:
+            revisiones = await asyncio.to_thread(self._escribir, filas, borrados)
+            # El objeto en memoria puede seguir en uso (WebSocket, mensajes en cola): lo escrito
+            # pasa a ser su base. Tras una fusión conserva la revisión vieja, así el próximo
+            # volcado vuelve a fusionar en vez de pisar lo del otro worker.
+            for uid, datos, _, _, _ in filas:
+                estado = self._en_vuelo[uid]
+                estado["_base"] = datos
+                if uid in revisiones:
+                    estado["_revision"] = revisiones[uid]
+        except Exception as e:
+            logger.error(f"Error volcando sesiones: {e}")
+            # Reintentar en el próximo ciclo sin pisar cambios más nuevos
+            for uid, estado in self._en_vuelo.items():
+                self._pendientes.setdefault(uid, estado)
+        finally:
+            self._en_vuelo = {}
+
+    async def _volcar_periodicamente(self) -> None:
+        while True:
+            await asyncio.sleep(self.intervalo_volcado)
+            await self.volcar()
+
+    async def iniciar(self) -> None:
+        self._tarea = asyncio.create_task(self._volcar_periodicamente())
+
+    async def detener(self) -> None:
+        if self._tarea:
+            self._tarea.cancel()
+        await self.volcar()
+
+def crear_almacen_sesiones() -> AlmacenSesiones:
+    if SESIONES_BACKEND == "sqlite":
+        return AlmacenSQLite(SESIONES_DB, SESIONES_VOLCADO_S)
+    return AlmacenMemoria()
+
+async def _barrer_sesiones_periodicamente() -> None:
+    while True:
+        await asyncio.sleep(SESIONES_BARRIDO_S)
+        try:
+            eliminadas = await ESTADOS.barrer(SESION_TTL_S)
+            if eliminadas:
+                logger.info(f"Sesiones expiradas eliminadas: {eliminadas}")
+        except Exception as e:
+            logger.error(f"Error en barrido de sesiones: {e}")
+
+ESTADOS: AlmacenSesiones = crear_almacen_sesiones()
+
+# ========== Registro de pedidos ==========
+class RegistroPedidos:
+    """Pedidos confirmados en un JSONL de solo-anexar.
+
+    El webhook solo encola; una tarea de fondo escribe por lotes con un fsync
+    por lote, así un disco lento no se nota en la confirmación. Cada lote es
+    una sola escritura en modo append, por lo que varios workers pueden
+    compartir el archivo.
+    """
+
+    def __init__(self, ruta: str, lote_max: int):
+        self.ruta = ruta
+        self.lote_max = lote_max
+        self._cola: asyncio.Queue = asyncio.Queue()  # None = terminar después de lo encolado
+        self._archivo = None
+        self._tarea: Optional[asyncio.Task] = None
+        self.encolados = 0
+        self.escritos = 0
+        self.lotes = 0
+        self.errores = 0
+
+    def encolar(self, pedido: Dict) -> None:
+        self._cola.put_nowait(pedido)
+        self.encolados += 1
+
+    def _escribir(self, datos: bytes) -> None:
+        self._archivo.write(datos)
+        os.fsync(self._archivo.fileno())
+
+    async def _guardar_lote(self, lote: List[Dict]) -> None:
+        datos = "".join(json.dumps(p, ensure_ascii=False) + "\n" for p in lote).encode("utf-8")
+        while True:
+            try:
+                await asyncio.to_thread(self._escribir, datos)
+                break
+            except OSError as e:
+                # Un pedido confirmado no se descarta: se reintenta hasta que el disco responda
+                self.errores += 1
+                logger.error(f"Error escribiendo {len(lote)} pedidos en {self.ruta}: {e}")
+                await asyncio.sleep(1)
+        self.escritos += len(lote)
+        self.lotes += 1
+
+    async def _escribir_lotes(self) -> None:
+        while True:
+            pedido = await self._cola.get()
+            fin = pedido is None
+            lote = [] if fin else [pedido]
+            while not fin and len(lote) < self.lote_max and not self._cola.empty():
+                pedido = self._cola.get_nowait()
+                if pedido is None:
+                    fin = True
+                else:
+                    lote.append(pedido)
+            if lote:
+                await self._guardar_lote(lote)
+            if fin:
+                return
+
+    def leer_pagina(self, cursor: int, limite: int) -> Tuple[List[bytes], int]:
+        """Hasta limite líneas completas desde el byte cursor, y el cursor siguiente"""
+        lineas: List[bytes] = []
+        try:
+            with open(self.ruta, "rb") as f:
+                f.seek(cursor)
+                while len(lineas) < limite:
+                    linea = f.readline()
+                    if not linea.endswith(b"\n"):
+                        break  # Fin del archivo o lote a medio escribir
+                    lineas.append(linea)
+                    cursor += len(linea)
+        except FileNotFoundError:
+            pass
+        return lineas, cursor
+
+    def estadisticas(self) -> Dict:
+        return {"encolados": self.encolados, "escritos": self.escritos, "en_cola": self._cola.qsize(),
+                "lotes": self.lotes, "errores": self.errores}
+
+    async def iniciar(self) -> None:
+        # La cola queda atada al event loop que la usa: se crea una por arranque
+        anterior, self._cola = self._cola, asyncio.Queue()
+        while not anterior.empty():
+            pedido = anterior.get_nowait()
+            if pedido is not None:
+                self._cola.put_nowait(pedido)
+        self._archivo = open(self.ruta, "ab", buffering=0)
+        self._tarea = asyncio.create_task(self._escribir_lotes())
+
+    async def detener(self) -> None:
+        """Vacía la cola antes de cerrar"""
+        if self._tarea is None:
+            return
+        self._cola.put_nowait(None)
+        try:
+            await asyncio.wait_for(self._tarea, timeout=10)
+        except asyncio.TimeoutError:
+            logger.error(f"Se cerró con {self._cola.qsize()} pedidos sin escribir en {self.ruta}")
+        self._archivo.close()
+
+PEDIDOS = RegistroPedidos(PEDIDOS_ARCHIVO, PEDIDOS_LOTE_MAX)
+
+# ========== Orden por usuario y admisión ==========
+class CandadosSesion:
+    """Un lock por usuario para procesar sus mensajes en orden.
+
+    La tabla está acotada: al superar el máximo se desalojan los menos recientes
+    que no tengan mensajes en curso ni en espera.
+    """
+
+    __slots__ = ("maximo", "_tabla")
+
+    def __init__(self, maximo: int):
+        self.maximo = maximo
+        self._tabla: "OrderedDict[str, list]" = OrderedDict()  # uid -> [lock, pendientes]
+
+    def pendientes(self, uid: str) -> int:
+        entrada = self._tabla.get(uid)
+        return entrada[1] if entrada else 0
+
+    @asynccontextmanager
+    async def turno(self, uid: str):
+        entrada = self._tabla.get(uid)
+        if entrada is None:
+            entrada = self._tabla[uid] = [asyncio.Lock(), 0]
+        else:
+            self._tabla.move_to_end(uid)
+        # Contar el turno antes de desalojar: con la tabla llena de usuarios ocupados la
+        # entrada recién creada sería la única libre y se iría con su lock en uso
+        entrada[1] += 1
+        self._desalojar()
+        try:
+            async with entrada[0]:
+                yield
+        finally:
+            entrada[1] -= 1
+
+    def _desalojar(self) -> None:
+        if len(self._tabla) <= self.maximo:
+            return
+        for uid, (_, pendientes) in list(self._tabla.items()):
+            if len(self._tabla) <= self.maximo:
+                break
+            if pendientes == 0:
+                del self._tabla[uid]
+
+    def __len__(self) -> int:
+        return len(self._tabla)
+
+CANDADOS = CandadosSesion(MAX_CANDADOS_SESION)
+ADMISION = {"rechazos_usuario": 0, "rechazos_llm": 0}
+
+# ========== Detección rápida mejorada ==========
+# Reglas en orden de prioridad: si varias coinciden gana la primera
+REGLAS_INTENCION: List[Tuple[str, str]] = [
+    # Saludos mejorados - SIN promoción en el saludo
+    ("saludo", r'^(hola|hey|hi|hello|buen[oa]s(\s*(d[ií]as|tardes|noches))?)\b'
+               r'|\b(qu[eé]\s*tal|c[oó]mo\s*est[aá]s|saludos|buen[oa]s)\b'
+               r'|^(ola|hey|hi|hello|buenas)'),
+    # Nueva detección para promociones específicas
+    ("promociones", r'\b(promociones?|ofertas?|descuentos?|especiales)\b'),
+    # Menú / catálogo
+    ("menu", r'\b(men[úu]|menu|productos|cat[aá]logo|qu[eé]\s*(tienes|vendes)|oferta|ofertas)\b'),
+    # Bebidas / no disponible
+    ("no_disponible", r'\b(bebidas?|gaseosa|jugo|agua|refresco|cerveza|licor|vino)\b'),
+    # Entrega
+    ("entrega_domicilio", r'\b(domicilio|env[ií]o|delivery|a mi casa|a domicilio|entregar|mandar)\b'),
+    ("entrega_tienda", r'\b(recoger|tienda|punto de recogida|pick\s*up|pasar por|buscar|recojer)\b'),
+    # Total
+    ("total", r'\b(total|cu[aá]nto\s+(va|debo|es|cuesta)|suma|valor)\b'),
+    # Confirmar
+    ("confirmar", r'\b(confirmar|confirmo|listo|ok|vale|s[ií]|acepto|de acuerdo)\b'),
+    # Despedida
+    ("despedida", r'\b(gracias|chao|adi[óo]s|hasta luego|bye|nos vemos|finalizar|terminar)\b'),
+]
+
+class EnrutadorIntenciones:
+    """Evalúa todas las reglas en un único escaneo compilado respetando su prioridad"""
+
+    __slots__ = ("_prioridad", "_patron", "aciertos", "sin_coincidencia")
+
+    def __init__(self, reglas: List[Tuple[str, str]]):
+        self._prioridad = {nombre: i for i, (nombre, _) in enumerate(reglas)}
+        alternativas = "|".join(f"(?P<{nombre}>{patron})" for nombre, patron in reglas)
+        # Todas las reglas empiezan en inicio de palabra: el conjunto de letras inicial
+        # deja que el motor salte rápido al siguiente candidato. El lookahead de ancho
+        # cero prueba cada inicio sin consumir texto, así una regla de menor prioridad
+        # nunca tapa a otra que empiece dentro de su coincidencia.
+        self._patron = re.compile(rf"(?=[a-zñáéíóú])\b(?=(?:{alternativas}))")
+        self.aciertos: Dict[str, int] = {nombre: 0 for nombre, _ in reglas}
+        self.sin_coincidencia = 0
+
+    def clasificar(self, texto: str) -> Optional[str]:
+        mejor: Optional[str] = None
+        for m in self._patron.finditer(texto):
+            nombre = m.lastgroup
+            if mejor is None or self._prioridad[nombre] < self._prioridad[mejor]:
+                mejor = nombre
+                if self._prioridad[nombre] == 0:
+                    break
+        if mejor is None:
+            self.sin_coincidencia += 1
+        else:
+            self.aciertos[mejor] += 1
+        return mejor
+
+ENRUTADOR = EnrutadorIntenciones(REGLAS_INTENCION)
+
+def detectar_intencion_basica(texto: str) -> Optional[Dict]:
+    regla = ENRUTADOR.clasificar(texto.lower())
+
+    if regla is None:
+        return None
+
+    if regla == "saludo":
+        return {"intencion": "saludo", "respuesta": saludo_dinamico()}  # ← SOLO saludo, sin promoción
+
+    if regla == "promociones":
+        return {"intencion": "promociones", "respuesta": generar_respuesta_promociones()}
+
+    if regla == "menu":
+        return {"intencion": "menu", "respuesta": generar_respuesta_menu()}
+
+    if regla == "no_disponible":
+        sugeridos = catalogo_actual().texto_sugeridos
+        return {"intencion": "no_disponible", "respuesta": f"Por ahora no manejamos bebidas 😅. Pero te puedo recomendar {sugeridos} — ¡son un hit! ¿Te gustaría agregar alguno? 😋"}
+
+    if regla == "entrega_domicilio":
+        return {"intencion": "entrega", "modo": "domicilio",
+                "respuesta": f"🚚 Perfecto, envío a domicilio. Protegemos tus datos según nuestras políticas: {POLITICA_DATOS_LINK}. ¿Deseas confirmar el pedido? ✅"}
+
+    if regla == "entrega_tienda":
+        return {"intencion": "entrega", "modo": "tienda",
+                "respuesta": "🏪 Genial, recoger en tienda. ¿Confirmamos tu pedido ahora? ✅"}
+
+    if regla == "total":
+        return {"intencion": "total"}
+
+    if regla == "confirmar":
+        return {"intencion": "confirmar"}
+
+    return {"intencion": "despedida", "respuesta": random.choice(DESPEDIDAS)}
+
+# ========== Clasificador local ==========
+_METODO_RE = re.compile(
+    r"\b(?P<transferencia>transferencia|transfiero|transferir|consigno|consignaci[oó]n|cuenta|nequi|daviplata)\b"
+    r"|\b(?P<efectivo>efectivo|cash|contra\s*entrega|al\s+recibir)\b"
+)
+_MODO_RE = re.compile(
+    r"\b(?P<domicilio>domicilios?|env[ií]os?|env[ií]en|traen|traer|lleven|llevar|mandan|casa|despachar|apartamento|oficina|porter[ií]a|direcci[oó]n)\b"
+    r"|\b(?P<tienda>recoger|recogerlo|recojo|tienda|local|punto|paso|voy)\b"
+)
+# Sobre texto normalizado (sin tildes). Los n-gramas no ven la negación: "no lo confirmes"
+# se parece a "confírmalo"; ni siquiera se pregunta, escala al LLM
+_NEGACION_RE = re.compile(r"\b(no|ni|nunca|tampoco|todavia|aun|espera|esperate|esperame)\b")
+
+def _opcion_unica(patron: re.Pattern, texto: str) -> str:
+    """Grupo de la única opción mencionada; "" si no hay ninguna o hay varias
+    ("lo recojo o me lo traen?")"""
+    opciones = {m.lastgroup for m in patron.finditer(texto)}
+    return opciones.pop() if len(opciones) == 1 else ""
+
+class ClasificadorIntenciones:
+    """Naive Bayes multinomial sobre n-gramas de caracteres, solo CPU"""
+
+    __slots__ = ("clases", "n_min", "n_max", "_log_prior", "_log_prob")
+
+    def __init__(self, frases: Dict[str, List[str]], n_min: int = 2, n_max: int = 4, alfa: float = 0.5):
+        self.clases = list(frases)
+        self.n_min, self.n_max = n_min, n_max
+        conteos = [dict() for _ in self.clases]
+        for k, clase in enumerate(self.clases):
+            for frase in frases[clase]:
+                for g in self._ngramas(frase):
+                    conteos[k][g] = conteos[k].get(g, 0) + 1
+        vocabulario = set().union(*conteos)
+        total_frases = sum(len(f) for f in frases.values())
+        self._log_prior = [math.log(len(frases[c]) / total_frases) for c in self.clases]
+        denominadores = [sum(c.values()) + alfa * len(vocabulario) for c in conteos]
+        # Una fila por n-grama con su log-probabilidad en cada clase
+        self._log_prob: Dict[str, Tuple[float, ...]] = {
+            g: tuple(math.log((conteos[k].get(g, 0) + alfa) / denominadores[k]) for k in range(len(self.clases)))
+            for g in vocabulario
+        }
+
+    def _ngramas(self, texto: str) -> List[str]:
+        t = f" {normalizar_texto(texto)} "
+        return [t[i:i + n] for n in range(self.n_min, self.n_max + 1) for i in range(len(t) - n + 1)]
+
+    def predecir(self, texto: str) -> Tuple[str, float]:
+        """Clase más probable y su probabilidad posterior"""
+        puntajes = list(self._log_prior)
+        vistos = 0
+        for g in self._ngramas(texto):
+            fila = self._log_prob.get(g)
+            if fila is None:
+                continue
+            vistos += 1
+            for k, lp in enumerate(fila):
+                puntajes[k] += lp
+        if not vistos:
+            return "otro", 0.0
+        # Naive Bayes satura la posterior con textos largos; se promedia por n-grama
+        escala = 1.0 / math.sqrt(vistos)
+        maximo = max(puntajes)
+        exps = [math.exp((p - maximo) * escala) for p in puntajes]
+        mejor = max(range(len(exps)), key=exps.__getitem__)
+        return self.clases[mejor], exps[mejor] / sum(exps)
+
+def cargar_clasificador(ruta: str) -> Optional[ClasificadorIntenciones]:
+    try:
+        with open(ruta, encoding="utf-8") as f:
+            return ClasificadorIntenciones(json.load(f))
+    except (OSError, ValueError) as e:
+        logger.warning(f"Clasificador local deshabilitado ({ruta}): {e}")
+        return None
+
+CLASIFICADOR = cargar_clasificador(CLASIFICADOR_FRASES)
+CLASIFICADOR_STATS = {"resueltos": 0, "escalados": 0}
+
+def interpretar_mensaje_local(texto: str, umbral: Optional[float] = None) -> Optional[Dict]:
+    """Interpreta sin LLM cuando el clasificador está seguro y la respuesta no cambia la
+    sesión; None para escalar.
+
+    Con ~9% de error en lo que resuelve, el clasificador no decide nada que haya que
+    deshacer: "confirmar" solo pregunta (confirma la regla exacta o el LLM) y un método
+    de pago o de entrega concreto lo registra el LLM.
+    """
+    if CLASIFICADOR is None:
+        return None
+    intencion, confianza = CLASIFICADOR.predecir(texto)
+    t = texto.lower()
+    if (intencion == "otro" or confianza < (CLASIFICADOR_UMBRAL if umbral is None else umbral)
+            or (intencion == "confirmar" and _NEGACION_RE.search(normalizar_texto(texto)))
+            or (intencion == "pago" and _opcion_unica(_METODO_RE, t))
+            or (intencion == "entrega" and _opcion_unica(_MODO_RE, t))):
+        CLASIFICADOR_STATS["escalados"] += 1
+        return None
+
+    resultado = {"intencion": intencion, "confianza": round(confianza, 3), "items": [], "respuesta": ""}
+    if intencion == "confirmar":
+        resultado["intencion"] = "pedir_confirmacion"
+    elif intencion == "pago":
+        resultado["metodo"] = ""
+    elif intencion == "entrega":
+        resultado["modo"] = ""
+    elif intencion == "menu":
+        resultado["respuesta"] = generar_respuesta_menu()
+    elif intencion == "recomendacion":
+        resultado["respuesta"] = generar_respuesta_recomendacion()
+    CLASIFICADOR_STATS["resueltos"] += 1
+    return resultado
+
+# ========== Cliente LLM asíncrono ==========
+_CLIENTE_LLM: Optional["openai.AsyncOpenAI"] = None
+_SEMAFORO_LLM = asyncio.Semaphore(LLM_MAX_CONCURRENTES)
+
+def cliente_llm() -> "openai.AsyncOpenAI":
+    """Cliente async compartido; lo crea el calentamiento del arranque o, si no, el primer uso"""
+    global _CLIENTE_LLM
+    if _CLIENTE_LLM is None:
+        import httpx
+        import openai
+        # Pool propio: tantas conexiones como llamadas simultáneas y keep-alive largo para
+        # no repetir TCP+TLS entre mensajes espaciados
+        limites = httpx.Limits(
+            max_connections=LLM_MAX_CONCURRENTES,
+            max_keepalive_connections=LLM_MAX_CONCURRENTES,
+            keepalive_expiry=LLM_KEEPALIVE_S,
+        )
+        _CLIENTE_LLM = openai.AsyncOpenAI(
+            api_key=OPENAI_API_KEY, timeout=LLM_TIMEOUT_S,
+            http_client=openai.DefaultAsyncHttpxClient(limits=limites, timeout=LLM_TIMEOUT_S),
+        )
+    return _CLIENTE_LLM
+
+class LectorRespuestaIncremental:
+    """Decodifica el valor de "respuesta" de un JSON que llega por fragmentos"""
+
+    _INICIO = re.compile(r'"respuesta"\s*:\s*"')
+    _ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos: Optional[int] = None  # índice del siguiente carácter del valor
+        self.terminado = False
+
+    def alimentar(self, fragmento: str) -> str:
+        """Agrega texto crudo y devuelve lo nuevo del campo ya decodificado"""
+        self._buffer += fragmento
+        if self.terminado:
+            return ""
+        if self._pos is None:
+            m = self._INICIO.search(self._buffer)
+            if not m:
+                return ""
+            self._pos = m.end()
+        salida = []
+        b, i = self._buffer, self._pos
+        while i < len(b):
+            c = b[i]
+            if c == '"':
+                self.terminado = True
+                i += 1
+                break
+            if c != "\\":
+                salida.append(c)
+                i += 1
+                continue
+            # Escape incompleto: esperar al siguiente fragmento
+            if i + 1 >= len(b):
+                break
+            if b[i + 1] == "u":
+                if i + 6 > len(b):
+                    break
+                codigo = int(b[i + 2:i + 6], 16)
+                if 0xD800 <= codigo < 0xDC00:
+                    # Par sustituto (emojis escapados): hace falta el segundo \uXXXX
+                    if i + 12 > len(b):
+                        break
+                    codigo = 0x10000 + ((codigo - 0xD800) << 10) + (int(b[i + 8:i + 12], 16) - 0xDC00)
+                    i += 6
+                salida.append(chr(codigo))
+                i += 6
+            else:
+                salida.append(self._ESCAPES.get(b[i + 1], b[i + 1]))
+                i += 2
+        self._pos = i
+        return "".join(salida)
+
+def _registrar_tokens(usage) -> None:
+    if not usage:
+        return
+    detalles = getattr(usage, "prompt_tokens_details", None)
+    cacheados = getattr(detalles, "cached_tokens", None) or 0
+    METRICAS.tokens["prompt"] += usage.prompt_tokens
+    METRICAS.tokens["prompt_cacheados"] += cacheados
+    METRICAS.tokens["completion"] += usage.completion_tokens
+    logger.info(f"Tokens LLM: prompt={usage.prompt_tokens} (cacheados={cacheados}) completion={usage.completion_tokens}")
+
+async def _consultar_llm(prompt: str, al_fragmento: Optional[Callable[[str], None]] = None) -> str:
+    """Llamada al proveedor limitada por el semáforo de concurrencia.
+
+    Con al_fragmento se pide la respuesta en streaming y se entrega el texto de
+    "respuesta" a medida que llega; el valor devuelto es siempre el JSON completo.
+    """
+    parametros = dict(
+        model=LLM_MODELO,
+        messages=[
+            {"role": "system", "content": catalogo_actual().prompt_sistema},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.7,
+        max_tokens=LLM_MAX_TOKENS
+    )
+    async with _SEMAFORO_LLM:
+        if al_fragmento is None:
+            resp = await cliente_llm().chat.completions.create(**parametros)
+            _registrar_tokens(resp.usage)
+            return resp.choices[0].message.content
+
+        lector = LectorRespuestaIncremental()
+        partes: List[str] = []
+        stream = await cliente_llm().chat.completions.create(
+            **parametros, stream=True, stream_options={"include_usage": True}
+        )
+        async for chunk in stream:
+            _registrar_tokens(chunk.usage)
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            partes.append(chunk.choices[0].delta.content)
+            nuevo = lector.alimentar(chunk.choices[0].delta.content)
+            if nuevo:
+                al_fragmento(nuevo)
+        return "".join(partes)
+
+# ========== Circuito LLM ==========
+class CircuitoLLM:
+    """Circuit breaker del proveedor LLM.
+
+    cerrado: las llamadas pasan y se observan en una ventana móvil; si la tasa
+    de errores o de llamadas lentas supera el umbral se abre.
+    abierto: no se llama al proveedor (respuesta degradada inmediata) durante
+    espera_s. semiabierto: pasan hasta `sondas` llamadas de prueba; si todas
+    salen bien se cierra, si alguna falla vuelve a abrirse.
+    """
+
+    def __init__(self, ventana_s: float, min_llamadas: int, tasa_error: float, latencia_s: float,
+                 tasa_lentas: float, espera_s: float, sondas: int):
+        self.ventana_s = ventana_s
+        self.min_llamadas = min_llamadas
+        self.tasa_error = tasa_error
+        self.latencia_s = latencia_s
+        self.tasa_lentas = tasa_lentas
+        self.espera_s = espera_s
+        self.sondas = sondas
+        self.estado = "cerrado"
+        self._ventana: deque = deque()  # (instante, error, lenta)
+        self._errores = 0
+        self._lentas = 0
+        self._reabrir_en = 0.0
+        self._sondas_en_curso = 0
+        self._sondas_ok = 0
+        self.rechazadas = 0
+        self.transiciones: deque = deque(maxlen=20)
+
+    def _cambiar(self, estado: str, motivo: str) -> None:
+        logger.warning(f"Circuito LLM: {self.estado} -> {estado} ({motivo})")
+        self.transiciones.append({"de": self.estado, "a": estado, "motivo": motivo,
+                                  "momento": datetime.now().isoformat(timespec="seconds")})
+        self.estado = estado
+        if estado == "abierto":
+            self._reabrir_en = time.monotonic() + self.espera_s
+        elif estado == "semiabierto":
+            self._sondas_en_curso = self._sondas_ok = 0
+        else:
+            self._ventana.clear()
+            self._errores = self._lentas = 0
+
+    def _podar(self, ahora: float) -> None:
+        limite = ahora - self.ventana_s
+        while self._ventana and self._ventana[0][0] < limite:
+            _, error, lenta = self._ventana.popleft()
+            self._errores -= error
+            self._lentas -= lenta
+
+    def permitir(self) -> bool:
+        """¿Puede salir una llamada nueva al proveedor? Quien recibe True debe llamar a registrar()"""
+        if self.estado == "abierto" and time.monotonic() >= self._reabrir_en:
+            self._cambiar("semiabierto", f"pasaron {self.espera_s:g}s")
+        if self.estado == "cerrado":
+            return True
+        if self.estado == "semiabierto" and self._sondas_en_curso < self.sondas:
+            self._sondas_en_curso += 1
+            return True
+        self.rechazadas += 1
+        return False
+
+    def registrar(self, exito: bool, duracion_s: float) -> None:
+        lenta = exito and duracion_s > self.latencia_s
+        if self.estado == "semiabierto":
+            if not exito or lenta:
+                self._cambiar("abierto", "falló una llamada de prueba" if not exito else "llamada de prueba lenta")
+            else:
+                self._sondas_ok += 1
+                if self._sondas_ok >= self.sondas:
+                    self._cambiar("cerrado", f"{self.sondas} llamadas de prueba correctas")
+            return
+        if self.estado != "cerrado":
+            return  # Respuestas tardías de antes de abrir
+        ahora = time.monotonic()
+        self._ventana.append((ahora, not exito, lenta))
+        self._errores += not exito
+        self._lentas += lenta
+        self._podar(ahora)
+        total = len(self._ventana)
+        if total < self.min_llamadas:
+            return
+        if self._errores / total >= self.tasa_error:
+            self._cambiar("abierto", f"{self._errores}/{total} errores en {self.ventana_s:g}s")
+        elif self._lentas / total >= self.tasa_lentas:
+            self._cambiar("abierto", f"{self._lentas}/{total} llamadas de más de {self.latencia_s:g}s")
+
+    def estadisticas(self) -> Dict:
+        self._podar(time.monotonic())
+        return {
+            "estado": self.estado,
+            "ventana": {"llamadas": len(self._ventana), "errores": self._errores, "lentas": self._lentas},
+            "rechazadas": self.rechazadas,
+            "transiciones": list(self.transiciones),
+        }
+
+CIRCUITO_LLM = CircuitoLLM(CIRCUITO_VENTANA_S, CIRCUITO_MIN_LLAMADAS, CIRCUITO_TASA_ERROR, CIRCUITO_LATENCIA_S,
+                           CIRCUITO_TASA_LENTAS, CIRCUITO_ESPERA_S, CIRCUITO_SONDAS)
+
+def respuesta_degradada() -> Dict:
+    return {"intencion": "degradado", "respuesta": catalogo_actual().texto_degradado}
+
+# ========== LLM conversacional con cache ==========
+_LLM_EN_VUELO: Dict[str, asyncio.Task] = {}  # clave de cache -> llamada compartida
+LLM_COALESCENCIA = {"llamadas": 0, "esperas_coalescidas": 0}
+
+def construir_prompt(texto_usuario: str, estado_actual=None) -> str:
+    """Parte variable del prompt: turnos recientes + carrito compacto + mensaje"""
+    carrito = estado_actual.get("carrito") if estado_actual else None
+    pedido = ", ".join(f"{i['producto']} x{i['cantidad']}" for i in carrito.items()) if carrito else "vacío"
+    contexto = contexto_llm(estado_actual)
+    historial = f"HISTORIAL:\n{contexto}\n" if contexto else ""
+    return f'{historial}PEDIDO: {pedido}\nCLIENTE: "{texto_usuario}"'
+
+async def _resolver_con_llm(clave: str, prompt: str, al_fragmento: Optional[Callable[[str], None]] = None) -> Dict:
+    """Una llamada al proveedor por clave; valida y cachea el resultado una sola vez"""
+    LLM_COALESCENCIA["llamadas"] += 1
+    # El plazo cubre la espera en el semáforo y la llamada al proveedor
+    inicio = time.perf_counter()
+    duracion: Optional[float] = None
+    exito = False
+    try:
+        raw = await asyncio.wait_for(_consultar_llm(prompt, al_fragmento), timeout=LLM_TIMEOUT_S)
+        duracion = time.perf_counter() - inicio
+        registrar_etapa("llm_proveedor", inicio)
+        # Un cuerpo que no es JSON cuesta una llamada igual que un error: cuenta como fallo
+        resultado = json.loads(extraer_json(raw))
+        if not isinstance(resultado, dict):
+            raise ValueError(f"respuesta del LLM no es un objeto JSON: {type(resultado).__name__}")
+        exito = True
+    finally:
+        CIRCUITO_LLM.registrar(exito, duracion if duracion is not None else time.perf_counter() - inicio)
+
+    # Validar y sanitizar items
+    if "items" in resultado:
+        resultado["items"] = validar_items_llm(resultado["items"])
+
+    # Cachear respuesta
+    LLM_CACHE.guardar(clave, resultado, catalogo_actual().version_cache)
+    return resultado
+
+async def interpretar_mensaje_con_LLM(texto_usuario: str, estado_actual=None,
+                                     al_fragmento: Optional[Callable[[str], None]] = None) -> Dict:
+    """al_fragmento recibe el texto en streaming solo si este mensaje origina la llamada"""
+    try:
+        # La clave incluye el carrito: la misma frase con otro pedido es otra consulta
+        clave = clave_cache_llm(texto_usuario, estado_actual)
+        cacheado = LLM_CACHE.obtener(clave)
+        if cacheado is not None:
+            logger.info(f"Usando respuesta cacheada para: {texto_usuario}")
+            marcar_tier("cache")
+            return cacheado
+        marcar_tier("llm")
+
+        # Mensajes idénticos concurrentes esperan la misma llamada en vuelo
+        tarea = _LLM_EN_VUELO.get(clave)
+        if tarea is None:
+            # Admisión global: mejor una respuesta rápida que una cola sin fondo
+            if len(_LLM_EN_VUELO) >= LLM_MAX_EN_VUELO:
+                ADMISION["rechazos_llm"] += 1
+                marcar_tier("rechazo")
+                return dict(RESPUESTA_OCUPADO)
+            # Con el proveedor caído no se hace esperar a nadie por una llamada condenada
+            if not CIRCUITO_LLM.permitir():
+                marcar_tier("degradado")
+                return respuesta_degradada()
+            prompt = construir_prompt(texto_usuario, estado_actual)
+            tarea = asyncio.create_task(_resolver_con_llm(clave, prompt, al_fragmento))
+            _LLM_EN_VUELO[clave] = tarea
+            tarea.add_done_callback(lambda _t: _LLM_EN_VUELO.pop(clave, None))
+        else:
+            LLM_COALESCENCIA["esperas_coalescidas"] += 1
+        # shield: si un cliente se desconecta no se cancela la llamada de los demás
+        return await asyncio.shield(tarea)
+
+    except asyncio.TimeoutError:
+        logger.warning(f"LLM excedió el plazo de {LLM_TIMEOUT_S}s para: {texto_usuario}")
+        METRICAS.error("llm_timeout")
+        return dict(RESPUESTA_NO_ENTENDIDO)
+    except Exception as e:
+        logger.error(f"Error en LLM: {e}")
+        METRICAS.error("llm")
+        return dict(RESPUESTA_NO_ENTENDIDO)
+
+# ========== Arranque ==========
+ARRANQUE = {"listo": False, "pasos_ms": {}, "total_ms": None}
+FRASES_CALENTAMIENTO = (
+    "hola, quiero 2 empanadas de carne y una pizza",
+    "me das tres empanadaz de pollo",
+    "cómo pago? efectivo o transferencia",
+    "qué me recomendás para 4 personas",
+    "confirmo el pedido, retiro en el local",
+)
+
+async def _calentar_emparejadores() -> None:
+    """Primer paso de cada frase tipo por enrutador, extractor (trie e índice difuso),
+    clasificador, normalizador y armado del prompt, fuera de cualquier petición"""
+    for frase in FRASES_CALENTAMIENTO:
+        texto = frase.lower()
+        for _ in ENRUTADOR._patron.finditer(texto):  # sin pasar por clasificar(): no suma estadísticas
+            pass
+        _METODO_RE.search(texto)
+        _MODO_RE.search(texto)
+        extraer_productos_y_cantidades(frase)
+        normalizar_texto(frase)
+        if CLASIFICADOR is not None:
+            CLASIFICADOR.predecir(frase)
+    construir_prompt(FRASES_CALENTAMIENTO[0], nueva_sesion())
+    json.loads(extraer_json('```json\n{"intencion": "menu", "items": []}\n```'))
+
+async def _crear_cliente_llm() -> None:
+    # Importar openai lleva cientos de ms: en un hilo para no frenar /health mientras tanto
+    await asyncio.to_thread(cliente_llm)
+
+async def _abrir_conexion_llm() -> None:
+    """Deja una conexión TCP+TLS con el proveedor en el pool; cualquier respuesta HTTP sirve"""
+    if LLM_CALENTAR_TIMEOUT_S <= 0:
+        return
+    import httpx
+    import openai
+    try:
+        await cliente_llm().with_options(timeout=LLM_CALENTAR_TIMEOUT_S, max_retries=0).get(
+            "/models", cast_to=httpx.Response
+        )
+    except openai.APIStatusError as e:
+        logger.info(f"Conexión al proveedor LLM abierta (HTTP {e.status_code})")
+    except Exception as e:
+        logger.warning(f"No se pudo abrir la conexión al proveedor LLM al arrancar: {e}")
+
+async def _calentar() -> None:
+    """Pasos de calentamiento tras el arranque; al terminar /ready pasa a 200"""
+    inicio = time.perf_counter()
+    for nombre, paso in (
+        ("emparejadores", _calentar_emparejadores),
+        ("cliente_llm", _crear_cliente_llm),
+        ("conexion_llm", _abrir_conexion_llm),
+    ):
+        t = time.perf_counter()
+        try:
+            await paso()
+        except Exception as e:
+            logger.error(f"Calentamiento '{nombre}' falló: {e}")
+        ARRANQUE["pasos_ms"][nombre] = round((time.perf_counter() - t) * 1000, 1)
+    ARRANQUE["total_ms"] = round(ARRANQUE["total_ms"] + (time.perf_counter() - inicio) * 1000, 1)
+    ARRANQUE["listo"] = True
+    logger.info(f"Listo en {ARRANQUE['total_ms']} ms: {ARRANQUE['pasos_ms']}")
+
+# ========== Esquemas ==========
+class MensajeWeb(BaseModel):
+    texto: str
+    usuario_id: str
+
+class LoteMensajes(BaseModel):
+    mensajes: List[MensajeWeb]
+
+# ========== Endpoints con manejo de errores ==========
+@app.post("/webhook/demo")
+async def webhook_demo(mensaje: MensajeWeb):
+    return await atender_mensaje(mensaje.usuario_id, mensaje.texto)
+
+@app.post("/webhook/demo/batch")
+async def webhook_demo_batch(lote: LoteMensajes):
+    """Varios mensajes (de uno o muchos usuarios) en una sola llamada.
+
+    Los mensajes de cada usuario se atienden en el orden recibido; usuarios
+    distintos avanzan en paralelo hasta LOTE_MAX_PARALELO. Los resultados
+    vuelven en el mismo orden que la entrada.
+    """
+    if len(lote.mensajes) > LOTE_MAX_MENSAJES:
+        raise HTTPException(status_code=413, detail=f"Máximo {LOTE_MAX_MENSAJES} mensajes por lote")
+
+    por_usuario: Dict[str, List[int]] = {}
+    for i, mensaje in enumerate(lote.mensajes):
+        por_usuario.setdefault(mensaje.usuario_id, []).append(i)
+    resultados: List[Optional[Dict]] = [None] * len(lote.mensajes)
+    semaforo = asyncio.Semaphore(LOTE_MAX_PARALELO)
+
+    async def _atender_usuario(indices: List[int]) -> None:
+        async with semaforo:
+            for i in indices:
+                mensaje = lote.mensajes[i]
+                resultados[i] = await atender_mensaje(mensaje.usuario_id, mensaje.texto)
+
+    await asyncio.gather(*(_atender_usuario(indices) for indices in por_usuario.values()))
+    return {"resultados": resultados}
+
+async def atender_mensaje(uid: str, texto: str, al_fragmento: Optional[Callable[[str], None]] = None,
+                          sesion: Optional[Dict] = None) -> Dict:
+    """Carga la sesión, resuelve el mensaje por tiers y registra métricas.
+
+    Con al_fragmento (modo streaming) el texto del LLM se va entregando y la
+    respuesta final incluye el carrito actualizado. Con sesion (WebSocket) se usa
+    ese estado ya cargado en lugar de buscarlo en ESTADOS.
+    """
+    medicion = MedicionPeticion()
+    _MEDICION.set(medicion)
+    # Toda la petición ve la misma versión del catálogo aunque se recargue a mitad
+    _CATALOGO_PETICION.set(CATALOGO)
+    try:
+        texto = texto.strip()
+
+        if not texto:
+            marcar_tier("rapida")
+            return {"respuesta": formatear_respuesta_web("¡Hola! 👋 ¿En qué puedo ayudarte hoy?"), "estado": "saludo"}
+
+        # Admisión por usuario: reintentos y dobles toques no se encolan sin límite
+        if CANDADOS.pendientes(uid) >= MAX_PENDIENTES_POR_USUARIO:
+            ADMISION["rechazos_usuario"] += 1
+            marcar_tier("rechazo")
+            return {"respuesta": formatear_respuesta_web("Dame un momento 🙏 aún estoy respondiendo tus mensajes anteriores."),
+                    "estado": "ocupado"}
+
+        # Los mensajes de un mismo usuario se procesan de a uno y en orden
+        async with CANDADOS.turno(uid):
+            estado = sesion if sesion is not None else ESTADOS.obtener(uid)
+            estado["timestamp"] = time.time()
+
+            respuesta = await _procesar_mensaje(texto, estado, uid, al_fragmento)
+            # "confirmado" cierra la sesión; cualquier otro estado se persiste
+            if respuesta.get("estado") != "confirmado":
+                if respuesta.get("estado") != "ocupado":
+                    estado["historia"].agregar(texto, respuesta["respuesta"].replace("<br>", " "))
+                ESTADOS.guardar(uid, estado)
+            if al_fragmento is not None:
+                respuesta["carrito"] = resumen_carrito(estado)
+            return respuesta
+
+    except Exception as e:
+        logger.error(f"Error en webhook_demo: {e}")
+        METRICAS.error("webhook")
+        medicion.tier = "error"
+        return {
+            "respuesta": formatear_respuesta_web("¡Ups! 😅 Tuve un problema. ¿Podrías intentarlo de nuevo?"),
+            "estado": "error"
+        }
+    finally:
+        duracion = time.perf_counter() - medicion.inicio
+        METRICAS.peticiones[medicion.tier].observar(duracion)
+        registrar_si_lenta(medicion, duracion, len(texto))
+
+def _resuelto(tier: str, inicio: float, respuesta: Dict) -> Dict:
+    """Cierra la etapa de respuesta y anota el tier que resolvió el mensaje"""
+    registrar_etapa("respuesta", inicio)
+    marcar_tier(tier)
+    return respuesta
+
+async def _procesar_mensaje(texto: str, estado: Dict, uid: str,
+                            al_fragmento: Optional[Callable[[str], None]] = None) -> Dict:
+    t = time.perf_counter()
+
+    # 1) Detección rápida
+    deteccion = detectar_intencion_basica(texto)
+    t = registrar_etapa("deteccion", t)
+    if deteccion:
+        return _resuelto("rapida", t, _manejar_deteccion_rapida(deteccion, estado, uid))
+
+    # 2) Extracción de productos
+    items_detectados = extraer_productos_y_cantidades(texto)
+    t = registrar_etapa("extraccion", t)
+    if items_detectados:
+        return _resuelto("items", t, _manejar_items_detectados(items_detectados, estado))
+
+    # 3) Clasificador local antes de pagar una llamada al LLM
+    resultado = interpretar_mensaje_local(texto)
+    t = registrar_etapa("clasificador", t)
+    if resultado:
+        return _resuelto("local", t, _manejar_respuesta_llm(resultado, estado, uid, texto))
+
+    # 4) LLM para casos complejos (interpretar_mensaje_con_LLM marca cache/llm)
+    resultado = await interpretar_mensaje_con_LLM(texto, estado_actual=estado, al_fragmento=al_fragmento)
+    t = registrar_etapa("llm", t)
+    respuesta = _manejar_respuesta_llm(resultado, estado, uid, texto)
+    registrar_etapa("respuesta", t)
+    return respuesta
+
+def _manejar_deteccion_rapida(deteccion: Dict, estado: Dict, uid: str) -> Dict:
+    intencion = deteccion["intencion"]
+    
+    if intencion == "saludo":
+        return {"respuesta": formatear_respuesta_web(deteccion["respuesta"]), "estado": "saludo"}
+    
+    elif intencion == "menu":
+        return {"respuesta": formatear_respuesta_web(deteccion["respuesta"]), "estado": "menu"}
+    
+    elif intencion == "no_disponible":
+        return {"respuesta": formatear_respuesta_web(deteccion["respuesta"]), "estado": "no_disponible"}
+    
+    elif intencion == "entrega":
+        estado["entrega"] = deteccion.get("modo")
+        return {"respuesta": formatear_respuesta_web(deteccion["respuesta"]), "estado": "entrega_confirmada"}
+    
+    elif intencion == "total":
+        carrito = estado["carrito"]
+        if not carrito:
+            return {"respuesta": formatear_respuesta_web("Aún no tienes productos en tu pedido. ¿Te muestro el menú? 😊"), "estado": "total"}
+        
+        return {
+            "respuesta": formatear_respuesta_web(f"🧮 Tu pedido va así:\n{carrito.desglose()}\n\nTotal: ${carrito.total:,}\n¿Confirmamos o agregas algo más?"),
+            "estado": "total"
+        }
+    
+    elif intencion == "confirmar":
+        return _confirmar_pedido(estado, uid)
+    
+    elif intencion == "despedida":
+        return {"respuesta": formatear_respuesta_web(deteccion["respuesta"]), "estado": "despedida"}
+    
+    return {"respuesta": formatear_respuesta_web("No entendí 😅 ¿Podrías reformular?"), "estado": "no_entendido"}
+
+def _manejar_items_detectados(items_detectados: List[Dict], estado: Dict) -> Dict:
+    carrito = estado["carrito"]
+    carrito.agregar_items(items_detectados)
+    total = carrito.total
+    desglose = carrito.desglose()
+    
+    respuestas = [
+        f"🛒 ¡Perfecto! He actualizado tu pedido:\n{desglose}\n\nTotal: ${total:,}\n¿Quieres agregar algo más o pasamos al pago? 💳",
+        f"✅ ¡Agregado! Tu pedido:\n{desglose}\n\n💰 Total: ${total:,}\n¿Deseas algo adicional?",
+        f"🎯 ¡Excelente elección! Ahora tienes:\n{desglose}\n\n💵 Total: ${total:,}\n¿Necesitas algo más?"
+    ]
+    
+    return {"respuesta": formatear_respuesta_web(random.choice(respuestas)), "estado": "pedido"}
+
+def _manejar_respuesta_llm(resultado: Dict, estado: Dict, uid: str, texto: str) -> Dict:
+    intencion = resultado.get("intencion", "no_entendido")
+    respuesta_llm = resultado.get("respuesta", "")
+    
+    if intencion == "pedido":
+        carrito = estado["carrito"]
+        carrito.agregar_items(validar_items_llm(resultado.get("items", [])))
+        total = carrito.total
+        desglose = carrito.desglose() or "— vacío —"
+        
+        return {
+            "respuesta": formatear_respuesta_web(respuesta_llm or f"🛒 Pedido actualizado:\n{desglose}\n\nTotal: ${total:,}\n¿Deseas algo más?"),
+            "estado": "pedido"
+        }
+    
+    elif intencion == "pago":
+        metodo = resultado.get("metodo")
+        if metodo:
+            estado["metodo"] = metodo
+            return {"respuesta": formatear_respuesta_web(f"💳 Perfecto, registré *{metodo}*. ¿Confirmamos el pedido? ✅"), "estado": "pago"}
+        return {"respuesta": formatear_respuesta_web(respuesta_llm or "💳 Aceptamos transferencia o efectivo. ¿Cuál prefieres?"), "estado": "pago"}
+    
+    elif intencion == "entrega":
+        modo = resultado.get("modo")
+        if modo == "domicilio":
+            estado["entrega"] = "domicilio"
+            txt = f"📦 ¡Listo! Enviaremos tu pedido a domicilio. Tus datos serán tratados según nuestras políticas: {POLITICA_DATOS_LINK}. ¿Deseas confirmar ahora? ✅"
+            return {"respuesta": formatear_respuesta_web(txt), "estado": "entrega_confirmada"}
+        elif modo == "tienda":
+            estado["entrega"] = "tienda"
+            return {"respuesta": formatear_respuesta_web("🏪 Perfecto, lo prepararemos para *recoger en tienda*. ¿Quieres confirmar tu pedido ahora? ✅"), "estado": "entrega_confirmada"}
+        else:
+            return {"respuesta": formatear_respuesta_web("¿Prefieres *recoger en tienda* o *envío a domicilio*? 🏪🚚"), "estado": "entrega_pendiente"}
+    
+    elif intencion == "confirmar":
+        return _confirmar_pedido(estado, uid)
+    
+    elif intencion == "pedir_confirmacion":
+        carrito = estado["carrito"]
+        if not carrito:
+            return {"respuesta": formatear_respuesta_web("Aún no tienes productos en tu pedido. ¿Te muestro el menú? 😊"), "estado": "menu"}
+        txt = f"🧮 Tu pedido:\n{carrito.desglose()}\n\nTotal: ${carrito.total:,}\n¿Lo confirmo? Responde *confirmo* y lo preparamos ✅"
+        return {"respuesta": formatear_respuesta_web(txt), "estado": "confirmacion_pendiente"}
+    
+    else:
+        return {"respuesta": formatear_respuesta_web(respuesta_llm or "No te entendí bien 😅 ¿Podrías decirlo de otra forma?"), "estado": intencion}
+
+def _confirmar_pedido(estado: Dict, uid: str) -> Dict:
+    if not estado["carrito"]:
+        return {"respuesta": formatear_respuesta_web("Aún no tienes productos en tu pedido. ¿Te muestro el menú? 😊"), "estado": "menu"}
+    
+    carrito = estado["carrito"]
+    total = carrito.total
+    pedido = {
+        "id": uuid.uuid4().hex,
+        "usuario_id": uid,
+        "items": carrito.a_lista(),
+        "total": total,
+        "metodo": estado.get("metodo"),
+        "entrega": estado.get("entrega"),
+        "ultima_actividad": datetime.fromtimestamp(estado["timestamp"]).isoformat(timespec="seconds"),
+        "confirmado": datetime.now().isoformat(timespec="seconds"),
+    }
+    # Solo se encola: la escritura a disco ocurre por lotes fuera de la petición
+    PEDIDOS.encolar(pedido)
+    ESTADOS.eliminar(uid)
+    
+    cierre = (
+        f"🎉 ¡Pedido confirmado! Total: ${total:,}<br>"
+        "En breve un asesor finalizará el proceso y coordinará la entrega. ¡Gracias por elegirnos! 🙌<br><br>"
+        "PS: Este es un *demo* de Tu Vendedor Inteligente (web/WhatsApp/IG). "
+        "¿Te gustaría tener uno así en tu empresa? 😉"
+    )
+    
+    return {"respuesta": formatear_respuesta_web(cierre), "estado": "confirmado", "pedido_id": pedido["id"]}
+
+def resumen_carrito(estado: Dict) -> Dict:
+    carrito = estado["carrito"]
+    return {"items": carrito.items(), "total": carrito.total}
+
+def _evento_sse(evento: str, datos: Dict) -> str:
+    return f"event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+
+@app.post("/webhook/demo/stream")
+async def webhook_demo_stream(mensaje: MensajeWeb):
+    """Variante SSE: eventos "fragmento" con el texto del LLM según llega y un "fin"
+    con la respuesta definitiva, el estado y el carrito. Los tiers rápidos solo emiten "fin"."""
+    cola: asyncio.Queue = asyncio.Queue()
+
+    async def _atender() -> Dict:
+        try:
+            return await atender_mensaje(mensaje.usuario_id, mensaje.texto, al_fragmento=cola.put_nowait)
+        finally:
+            cola.put_nowait(None)
+
+    async def eventos():
+        # La tarea sigue aunque el cliente se desconecte, para no perder el carrito
+        tarea = asyncio.create_task(_atender())
+        while (fragmento := await cola.get()) is not None:
+            yield _evento_sse("fragmento", {"texto": formatear_respuesta_web(fragmento)})
+        yield _evento_sse("fin", await tarea)
+
+    return StreamingResponse(eventos(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+WS_STATS = {"conexiones": 0, "abiertas": 0, "mensajes": 0, "rechazados": 0, "cierres_inactividad": 0}
+
+@app.websocket("/ws/demo")
+async def ws_demo(websocket: WebSocket, usuario_id: str):
+    """Chat persistente: una conexión = un usuario, con la sesión cargada una vez.
+
+    El cliente envía texto (o {"texto": ...}; los frames binarios se leen como
+    UTF-8); el servidor empuja eventos JSON
+    {"tipo": "fragmento"|"respuesta"|"ocupado"|"error", ...} a medida que están listos.
+    Las colas acotadas dan contrapresión: si el cliente no lee, se deja de
+    procesar; si envía más rápido de lo que se responde, se rechaza el excedente.
+    """
+    await websocket.accept()
+    WS_STATS["conexiones"] += 1
+    WS_STATS["abiertas"] += 1
+    entrada: asyncio.Queue = asyncio.Queue(maxsize=WS_COLA_ENTRADA)
+    salida: asyncio.Queue = asyncio.Queue(maxsize=WS_COLA_SALIDA)
+
+    def _fragmento(texto: str) -> None:
+        # Los fragmentos son prescindibles: la respuesta final trae el texto completo
+        if not salida.full():
+            salida.put_nowait({"tipo": "fragmento", "texto": formatear_respuesta_web(texto)})
+
+    procesando = cerrada = False
+
+    async def _procesar() -> None:
+        nonlocal procesando
+        sesion = ESTADOS.obtener(usuario_id)
+        while True:
+            texto = await entrada.get()
+            procesando = True
+            try:
+                respuesta = await atender_mensaje(usuario_id, texto, al_fragmento=_fragmento, sesion=sesion)
+            finally:
+                procesando = False
+            if respuesta.get("estado") == "confirmado":
+                sesion = nueva_sesion()
+            if cerrada:
+                return
+            await salida.put({"tipo": "respuesta", **respuesta})
+
+    async def _enviar() -> None:
+        try:
+            while True:
+                await websocket.send_json(await salida.get())
+        except (WebSocketDisconnect, RuntimeError):
+            pass  # El cliente se fue; el bucle de recepción se entera y cierra
+
+    tareas = [asyncio.create_task(_procesar()), asyncio.create_task(_enviar())]
+    try:
+        while True:
+            try:
+                mensaje = await asyncio.wait_for(websocket.receive(), timeout=WS_INACTIVIDAD_S)
+            except asyncio.TimeoutError:
+                WS_STATS["cierres_inactividad"] += 1
+                await websocket.close(code=1000, reason="inactividad")
+                break
+            if mensaje["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(mensaje.get("code", 1000))
+            crudo = mensaje.get("text")
+            if crudo is None:
+                # receive_text() fallaría con KeyError ante un frame binario
+                try:
+                    crudo = (mensaje.get("bytes") or b"").decode("utf-8")
+                except UnicodeDecodeError:
+                    WS_STATS["rechazados"] += 1
+                    if not salida.full():
+                        salida.put_nowait({"tipo": "error", "respuesta": formatear_respuesta_web(
+                            "No pude leer ese mensaje 😅 ¿Me lo escribes de nuevo?")})
+                    continue
+            texto = crudo
+            if crudo.startswith("{"):
+                try:
+                    texto = str(json.loads(crudo).get("texto", ""))
+                except (ValueError, AttributeError):
+                    pass
+            WS_STATS["mensajes"] += 1
+            if len(texto) > WS_MAX_CARACTERES or entrada.full():
+                WS_STATS["rechazados"] += 1
+                if not salida.full():
+                    salida.put_nowait({"tipo": "ocupado", "respuesta": formatear_respuesta_web(
+                        "Dame un momento 🙏 aún estoy respondiendo tus mensajes anteriores."
+                        if entrada.full() else "Ese mensaje es muy largo 😅 ¿Me lo resumes?")})
+                continue
+            entrada.put_nowait(texto)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # Lo que estaba en cola se descarta, pero un mensaje a medio procesar
+        # termina para no perder el cambio de carrito
+        cerrada = True
+        tareas[1].cancel()
+        if not procesando:
+            tareas[0].cancel()
+        WS_STATS["abiertas"] -= 1
+
+@app.post("/webhook/demo/reset")
+async def reset(usuario_id: str):
+    ESTADOS.eliminar(usuario_id)
+    return {"status": "ok", "message": "Conversación reiniciada"}
+
+@app.get("/health")
+async def health():
+    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+
+@app.get("/ready")
+async def ready():
+    """503 hasta que el calentamiento termina (y de nuevo al apagar); /health sigue siendo liveness"""
+    return JSONResponse(ARRANQUE, status_code=200 if ARRANQUE["listo"] else 503)
+
+@app.get("/stats")
+async def stats():
+    return {
+        "usuarios_activos": len(ESTADOS),
+        "cache_llm": LLM_CACHE.estadisticas(),
+        "intenciones": {**ENRUTADOR.aciertos, "sin_coincidencia": ENRUTADOR.sin_coincidencia},
+        "clasificador_local": CLASIFICADOR_STATS,
+        "llm": {**LLM_COALESCENCIA, "en_vuelo": len(_LLM_EN_VUELO)},
+        "circuito_llm": CIRCUITO_LLM.estadisticas(),
+        "admision": {**ADMISION, "candados": len(CANDADOS)},
+        "pedidos": PEDIDOS.estadisticas(),
+        "websocket": WS_STATS,
+        "productos": len(catalogo_actual().productos),
+        "catalogo": {**CATALOGO_STATS, "version": CATALOGO.version, "alias": len(CATALOGO.alias)},
+        "diagnostico": DIAGNOSTICO_STATS
+    }
+
+def _verificar_admin(x_admin_token: Optional[str]) -> None:
+    # Sin ADMIN_TOKEN los endpoints de administración no existen: exponen datos de todos los clientes
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(x_admin_token or "", ADMIN_TOKEN):
+        raise HTTPException(status_code=401, detail="Token de administración inválido")
+
+@app.get("/orders")
+async def exportar_pedidos(cursor: int = 0, limite: int = 100, x_admin_token: Optional[str] = Header(None)):
+    """Pedidos confirmados en NDJSON, paginados por byte: el encabezado
+    X-Siguiente-Cursor es el cursor de la página siguiente"""
+    _verificar_admin(x_admin_token)
+    if cursor < 0:
+        raise HTTPException(status_code=400, detail="cursor debe ser >= 0")
+    limite = max(1, min(limite, PEDIDOS_PAGINA_MAX))
+    lineas, siguiente = await asyncio.to_thread(PEDIDOS.leer_pagina, cursor, limite)
+    return StreamingResponse(iter(lineas), media_type="application/x-ndjson",
+                             headers={"X-Siguiente-Cursor": str(siguiente)})
+
+@app.get("/debug/lentas")
+async def peticiones_lentas(x_admin_token: Optional[str] = Header(None)):
+    """Últimos mensajes que superaron LENTAS_UMBRAL_MS, del más viejo al más nuevo"""
+    _verificar_admin(x_admin_token)
+    return {"umbral_ms": LENTAS_UMBRAL_MS, "total": DIAGNOSTICO_STATS["lentas"], "peticiones": list(PETICIONES_LENTAS)}
+
+@app.get("/debug/perfil", response_class=PlainTextResponse)
+async def perfil(segundos: float = 10, x_admin_token: Optional[str] = Header(None)):
+    """Perfil muestreado de `segundos` de tráfico real en pilas colapsadas,
+    listo para flamegraph.pl o speedscope. El primer marco de cada pila es el nombre del hilo."""
+    _verificar_admin(x_admin_token)
+    if PERFILADOR_MAX_S <= 0:
+        raise HTTPException(status_code=404, detail="Perfilador deshabilitado (PERFILADOR_MAX_S)")
+    if not 0 < segundos <= PERFILADOR_MAX_S:
+        raise HTTPException(status_code=400, detail=f"segundos debe estar entre 0 y {PERFILADOR_MAX_S}")
+    if not _PERFILANDO.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="Ya hay un perfil en curso")
+    try:
+        # El muestreo corre en un hilo: el event loop sigue atendiendo y aparece en las pilas
+        conteos, rondas = await asyncio.to_thread(perfilar, segundos, PERFILADOR_INTERVALO_MS / 1000)
+    finally:
+        _PERFILANDO.release()
+    DIAGNOSTICO_STATS["perfiles"] += 1
+    cuerpo = "".join(f"{pila} {n}\n" for pila, n in sorted(conteos.items(), key=lambda kv: -kv[1]))
+    return PlainTextResponse(cuerpo, headers={"X-Muestras": str(rondas)})
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(METRICAS.exponer(), media_type="text/plain; version=0.0.4")
+
+@app.get("/")
+async def root():
+    return {
+        "message": "Tu Vendedor Inteligente está activo 🤖", 
+        "version": "3.0",
+        "estado": "optimizado"
+    }
+
+
+
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Reporte offline del clasificador local: precisión, latencia y tráfico que deja de ir al LLM.
+
+Hace validación cruzada k-fold sobre frases_intencion.json y recorre la conversación de test.py
+por los tiers del webhook para ver cuántos mensajes resuelve cada uno.
+
+Uso: python reporte_clasificador.py [--folds 5] [--umbral 0.7]
+"""
+import argparse
+import json
+import random
+import time
+
+import main
+
+CONVERSACION = [
+    "hola", "qué productos tienes?", "y qué me recomiendas?",
+    "quiero 2 empanadas y una pizza", "ponle 3 deditos de mozzarella", "cancela la pizza", "cuánto va el total?",
+    "cómo pago?", "transferencia", "sí, confírmalo",
+    "venden bebidas?", "es congelado o ya viene listo?", "se puede recoger en tienda?",
+    "tengo alergia, qué ingredientes tienen las empanadas?",
+    "estoy planeando una reunión familiar", "gracias",
+]
+
+
+def validacion_cruzada(frases, folds, umbral, semilla=7):
+    ejemplos = [(texto, clase) for clase, textos in frases.items() for texto in textos]
+    random.Random(semilla).shuffle(ejemplos)
+    resueltos = aciertos_resueltos = aciertos = 0
+    latencias = []
+    for f in range(folds):
+        prueba = ejemplos[f::folds]
+        entrenamiento = {}
+        for i, (texto, clase) in enumerate(ejemplos):
+            if i % folds != f:
+                entrenamiento.setdefault(clase, []).append(texto)
+        clasificador = main.ClasificadorIntenciones(entrenamiento)
+        for texto, clase in prueba:
+            t0 = time.perf_counter()
+            pred, confianza = clasificador.predecir(texto)
+            latencias.append(time.perf_counter() - t0)
+            aciertos += pred == clase
+            # Solo cuenta como desviado del LLM lo que el webhook resolvería localmente
+            if pred != "otro" and confianza >= umbral:
+                resueltos += 1
+                aciertos_resueltos += pred == clase
+    latencias.sort()
+    n = len(ejemplos)
+    return {
+        "ejemplos": n,
+        "exactitud_global": round(aciertos / n, 3),
+        "resueltos_localmente": round(resueltos / n, 3),
+        "precision_resueltos": round(aciertos_resueltos / resueltos, 3) if resueltos else None,
+        "latencia_p50_us": round(latencias[n // 2] * 1e6, 1),
+        "latencia_p99_us": round(latencias[int(n * 0.99)] * 1e6, 1),
+    }
+
+
+def tiers_conversacion(umbral):
+    tiers = {}
+    for texto in CONVERSACION:
+        if main.detectar_intencion_basica(texto):
+            tier = "rapida"
+        elif main.extraer_productos_y_cantidades(texto):
+            tier = "items"
+        else:
+            # Misma decisión que el webhook, con las intenciones que escalan por seguridad
+            tier = "local" if main.interpretar_mensaje_local(texto, umbral) else "llm"
+        tiers.setdefault(tier, []).append(texto)
+    return tiers
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--umbral", type=float, default=main.CLASIFICADOR_UMBRAL)
+    args = parser.parse_args()
+
+    with open(main.CLASIFICADOR_FRASES, encoding="utf-8") as f:
+        frases = json.load(f)
+
+    print("== Validación cruzada ==")
+    print(json.dumps(validacion_cruzada(frases, args.folds, args.umbral), indent=2, ensure_ascii=False))
+
+    print("\n== Conversación de test.py por tier ==")
+    tiers = tiers_conversacion(args.umbral)
+    for tier, textos in tiers.items():
+        print(f"{tier:>7}: {len(textos):>2}  {textos}")
+    sin_local = len(tiers.get("llm", [])) + len(tiers.get("local", []))
+    if sin_local:
+        print(f"\nLlamadas al LLM evitadas: {len(tiers.get('local', []))}/{sin_local}")
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""El clasificador local no puede confirmar pedidos: confirmar es irreversible.
+
+Uso: python -m pytest -q test_clasificador.py
+"""
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+APLAZAN_O_NIEGAN = [
+    "perfecto, déjame pensarlo",
+    "así está bien por ahora, mañana pido",
+    "bien",
+    "todavía no lo confirmes",
+    "espera no confirmes aun",
+    "no lo confirmes todavía",
+    "no, no confirmes",
+    "no, mejor no",
+]
+
+
+class LLMSinConfirmar:
+    """Proveedor simulado que nunca confirma: cualquier confirmación vendría del clasificador"""
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._crear))
+
+    async def _crear(self, **kwargs):
+        contenido = json.dumps({"intencion": "otro", "items": [], "respuesta": "Claro, sin apuro."})
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=contenido))], usage=None)
+
+
+@pytest.fixture
+def llm_simulado(monkeypatch):
+    monkeypatch.setattr(main, "_CLIENTE_LLM", LLMSinConfirmar())
+
+
+@pytest.mark.parametrize("texto", APLAZAN_O_NIEGAN)
+def test_clasificador_no_resuelve_confirmar(texto):
+    resultado = main.interpretar_mensaje_local(texto)
+    assert resultado is None or resultado["intencion"] != "confirmar"
+
+
+@pytest.mark.parametrize("texto", APLAZAN_O_NIEGAN)
+def test_aplazar_no_confirma_el_pedido(texto, llm_simulado):
+    uid = f"test-{texto}"
+
+    async def conversar():
+        await main.atender_mensaje(uid, "quiero 2 empanadas y una pizza")
+        return await main.atender_mensaje(uid, texto)
+
+    respuesta = asyncio.run(conversar())
+    assert respuesta["estado"] != "confirmado"
+    assert len(main.ESTADOS.obtener(uid)["carrito"]) == 2
+    main.ESTADOS.eliminar(uid)
+
+
+@pytest.mark.parametrize("texto", ["transferencia", "lo recojo en la tienda"])
+def test_clasificador_no_registra_metodo_ni_entrega(texto):
+    assert main.interpretar_mensaje_local(texto) is None
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""Falsos positivos del extractor: palabras comunes que no deben llegar al carrito.
+
+Uso: python -m pytest -q test_extractor.py
+"""
+import pytest
+
+import main
+
+SIN_PRODUCTOS = [
+    "qué pasa con mi pedido",
+    "tengo prisa",
+    "pago con visa",
+    "pasa por mi casa",
+    "la misa",
+    "una pila",
+    "piso 3",
+    "no me pasa nada",
+    "la casa queda en el piso 4",
+    "vivo en la pista 2",
+    "es para una fiesta",
+    "dos pesos de cambio",
+    "me da risa",
+    "una prisa tremenda",
+    "tengo una duda",
+    "es para llevar",
+    "pásame el precio",
+    # En contexto de pedido: dos errores solo se toleran en palabras largas
+    "necesito 2 pastillas",
+    "más pastillas",
+]
+
+CON_ERRORES_DE_TIPEO = [
+    ("quiero 3 empanadaz y una pisa", [("empanadas", 3), ("pizza personal", 1)]),
+    ("dame 2 dedos de mozarela", [("deditos de mozzarella", 2)]),
+    ("pisa", [("pizza personal", 1)]),
+]
+
+REPETIDOS = [
+    ("una pizza y otra pizza", [("pizza personal", 2)]),
+    ("quiero pizza y pizza", [("pizza personal", 2)]),
+]
+
+
+@pytest.mark.parametrize("texto", SIN_PRODUCTOS)
+def test_palabras_comunes_no_son_productos(texto):
+    assert main.extraer_productos_y_cantidades(texto) == []
+
+
+@pytest.mark.parametrize("texto,esperado", CON_ERRORES_DE_TIPEO)
+def test_errores_de_tipeo_en_contexto_de_pedido(texto, esperado):
+    items = main.extraer_productos_y_cantidades(texto)
+    assert [(i["producto"], i["cantidad"]) for i in items] == esperado
+
+
+@pytest.mark.parametrize("texto,esperado", REPETIDOS)
+def test_menciones_repetidas_se_suman(texto, esperado):
+    items = main.extraer_productos_y_cantidades(texto)
+    assert [(i["producto"], i["cantidad"]) for i in items] == esperado